@@ -0,0 +1,123 @@
+"""Admission control for the LLM-backed chat endpoints of the API service."""
+
+from typing import AsyncIterator
+from collections import deque
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+
+import asyncio
+import logging
+import os
+import time
+
+from priority import PriorityLimiter, current_lane
+
+load_dotenv()
+
+# Chat requests running at once across all users
+CHAT_MAX_CONCURRENT = int(os.getenv('CHAT_MAX_CONCURRENT', 32))
+# Of them, slots that scheduled jobs can't take
+CHAT_INTERACTIVE_RESERVED = int(os.getenv('CHAT_INTERACTIVE_RESERVED', 8))
+# Chat requests running at once for one user
+CHAT_MAX_PER_USER = int(os.getenv('CHAT_MAX_PER_USER', 1))
+# Requests allowed to wait for a free slot, the rest are shed immediately
+CHAT_MAX_QUEUE = int(os.getenv('CHAT_MAX_QUEUE', 128))
+# How long a request can wait for a free slot before it is shed, seconds
+CHAT_QUEUE_TIMEOUT = float(os.getenv('CHAT_QUEUE_TIMEOUT', 10.0))
+# How often queue metrics are logged, seconds
+CHAT_STATS_INTERVAL = float(os.getenv('CHAT_STATS_INTERVAL', 60.0))
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed because the chat endpoints are saturated"""
+
+
+class AdmissionController:
+    """Limits concurrent chat requests globally and per user, with a bounded wait queue"""
+
+    def __init__(self, max_concurrent: int = CHAT_MAX_CONCURRENT, max_per_user: int = CHAT_MAX_PER_USER, max_queue: int = CHAT_MAX_QUEUE, queue_timeout: float = CHAT_QUEUE_TIMEOUT):
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._global = PriorityLimiter('chat', max_concurrent, CHAT_INTERACTIVE_RESERVED)
+        self._users: dict[int, asyncio.Semaphore] = {}
+        self._user_refs: dict[int, int] = {}
+        self.waiting = 0
+        self.running = 0
+        self.admitted = 0
+        self.shed = 0
+        self.queue_times = deque(maxlen=1000)
+
+    async def _acquire(self, user_semaphore: asyncio.Semaphore, lane: str) -> None:
+        await user_semaphore.acquire()
+        try:
+            await self._global.acquire(lane)
+        except BaseException:
+            user_semaphore.release()
+            raise
+
+    @asynccontextmanager
+    async def admit(self, key: int) -> AsyncIterator[None]:
+        """Waits for a free slot for the user, raises Overloaded if the request is shed"""
+
+        if self.waiting >= self.max_queue:
+            self.shed += 1
+            raise Overloaded(f'Chat queue is full ({self.waiting} waiting)')
+
+        lane = current_lane.get()
+        user_semaphore = self._users.setdefault(key, asyncio.Semaphore(self.max_per_user))
+        self._user_refs[key] = self._user_refs.get(key, 0) + 1
+        try:
+            start = time.monotonic()
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._acquire(user_semaphore, lane), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.shed += 1
+                raise Overloaded(f'No free chat slot after {self.queue_timeout} seconds')
+            finally:
+                self.waiting -= 1
+            self.queue_times.append(time.monotonic() - start)
+            self.admitted += 1
+
+            self.running += 1
+            try:
+                yield
+            finally:
+                self.running -= 1
+                self._global.release(lane)
+                user_semaphore.release()
+        finally:
+            self._user_refs[key] -= 1
+            if not self._user_refs[key]:
+                del self._user_refs[key]
+                del self._users[key]
+
+    def interactive_load(self) -> float:
+        """Returns the share of the chat slots that users' requests take or wait for, 0 when nobody is chatting"""
+        stats = self._global.stats()
+        return (stats['interactive_running'] + stats['interactive_waiting']) / self._global.capacity
+
+    def stats(self) -> dict:
+        """Returns queue metrics: current load, counters and queue time percentiles in seconds"""
+
+        ordered = sorted(self.queue_times)
+        def percentile(q: float) -> float:
+            return ordered[min(len(ordered) - 1, int(len(ordered) * q))] if ordered else 0.0
+
+        return {
+            'running': self.running,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'shed': self.shed,
+            'queue_time_p50': percentile(0.5),
+            'queue_time_p95': percentile(0.95),
+            'queue_time_max': ordered[-1] if ordered else 0.0,
+            **self._global.stats(),
+        }
+
+    async def report_stats(self, interval: float = CHAT_STATS_INTERVAL) -> None:
+        """Logs queue metrics periodically, meant to be run as a background task"""
+        while True:
+            await asyncio.sleep(interval)
+            logging.info(f"Chat admission stats: {self.stats()}")
@@ -0,0 +1,81 @@
+"""Push-driven delivery of initial advice pieces: "advice ready" and "consultation complete" events on a Redis stream."""
+
+from typing import Any, Awaitable, Callable, Optional
+from dotenv import load_dotenv
+
+import argparse
+import asyncio
+import os
+
+from redis_pool import get_redis
+from redis_streams import StreamConsumer, STREAM_MAXLEN
+
+load_dotenv()
+
+# 'poll' asks the API for new pieces every UPDATE_INTERVAL, 'push' waits for the events
+ADVICE_DELIVERY_MODE = os.getenv('ADVICE_DELIVERY_MODE', 'poll')
+
+ADVICE_EVENTS_STREAM = 'advice:events'
+ADVICE_EVENTS_DEAD_STREAM = 'advice:events:dead'
+ADVICE_EVENTS_GROUP = 'advice-delivery'
+ADVICE_EVENTS_BATCH_SIZE = int(os.getenv('ADVICE_EVENTS_BATCH_SIZE', 50))
+ADVICE_EVENTS_MAX_ATTEMPTS = int(os.getenv('ADVICE_EVENTS_MAX_ATTEMPTS', 3))
+ADVICE_EVENTS_RETRY_IDLE_MS = int(os.getenv('ADVICE_EVENTS_RETRY_IDLE_MS', 60 * 1000))
+
+ADVICE_READY = 'advice_ready'
+CONSULTATION_COMPLETE = 'consultation_complete'
+
+EventHandler = Callable[[int, Optional[str]], Awaitable[None]]
+
+
+def push_mode() -> bool:
+    return ADVICE_DELIVERY_MODE == 'push'
+
+async def publish_event(event_type: str, telegram_id: int, text: Optional[str] = None) -> None:
+    """
+    Publishes an advice event. The API service publishes them in production, this function is the local stand-in.
+    The text of the piece is optional, without it the bot fetches the piece from the API.
+    """
+
+    if event_type not in (ADVICE_READY, CONSULTATION_COMPLETE):
+        raise ValueError(f'Unknown advice event: {event_type}')
+    fields = {'type': event_type, 'telegram_id': telegram_id}
+    if text is not None:
+        fields['text'] = text
+    await get_redis().xadd(ADVICE_EVENTS_STREAM, fields, maxlen=STREAM_MAXLEN, approximate=True)
+
+
+class AdviceEventConsumer(StreamConsumer):
+    """Delivers advice pieces and completes initial consultations as the events arrive"""
+
+    def __init__(self, on_advice_ready: EventHandler, on_consultation_complete: EventHandler):
+        super().__init__(ADVICE_EVENTS_STREAM, ADVICE_EVENTS_GROUP, ADVICE_EVENTS_DEAD_STREAM, ADVICE_EVENTS_BATCH_SIZE, ADVICE_EVENTS_MAX_ATTEMPTS, ADVICE_EVENTS_RETRY_IDLE_MS)
+        self.handlers = {
+            ADVICE_READY: on_advice_ready,
+            CONSULTATION_COMPLETE: on_consultation_complete,
+        }
+
+    async def handle_entry(self, fields: dict, **shared: Any) -> None:
+        text = fields.get(b'text')
+        await self.handlers[fields[b'type'].decode()](int(fields[b'telegram_id']), text.decode() if text is not None else None)
+
+    async def handle_batch(self, entries: list) -> None:
+        # events of one user are handled in order, different users don't depend on each other
+        by_user: dict[bytes, list] = {}
+        for entry_id, fields in entries:
+            by_user.setdefault(fields[b'telegram_id'], []).append((entry_id, fields))
+
+        async def handle_user_entries(user_entries: list) -> None:
+            for entry_id, fields in user_entries:
+                await self.process_entry(entry_id, fields)
+
+        await asyncio.gather(*(handle_user_entries(user_entries) for user_entries in by_user.values()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Publish an advice event, e.g. to test the push mode locally')
+    parser.add_argument('event_type', choices=[ADVICE_READY, CONSULTATION_COMPLETE])
+    parser.add_argument('telegram_id', type=int)
+    parser.add_argument('--text', default=None)
+    args = parser.parse_args()
+    asyncio.run(publish_event(args.event_type, args.telegram_id, args.text))
@@ -0,0 +1,187 @@
+"""Typed client for the API service. Every response is decoded once with orjson into a slotted model."""
+
+from typing import Iterator, Optional
+from dataclasses import dataclass
+
+import httpx
+
+import lookup_cache
+from to_api_utils import decode, hedged_get, BACKEND_API_ENDPOINT, HEADERS, CHAT_TIMEOUT, WRITE_TIMEOUT
+from utils import clean_text
+from tracing import traced
+
+
+class BackendResponseError(Exception):
+    """Raised when a response of the API service doesn't have the expected fields"""
+
+class MessageNotFound(Exception):
+    """Raised when an assistant message can't be found by its text"""
+
+
+def _require(data: dict, key: str, model: str):
+    try:
+        return data[key]
+    except (KeyError, TypeError):
+        raise BackendResponseError(f'{model} response has no {key}: {data!r:.200}')
+
+
+@dataclass(slots=True)
+class Profile:
+    preferred_lang: str
+    name: Optional[str] = None
+    tg_username: Optional[str] = None
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'Profile':
+        return cls(preferred_lang=_require(data, 'preferred_lang', 'Profile'), name=data.get('name'), tg_username=data.get('tg_username'))
+
+
+@dataclass(slots=True)
+class User:
+    id: int
+    email: str
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'User':
+        return cls(id=_require(data, 'id', 'User'), email=_require(data, 'email', 'User'))
+
+
+@dataclass(slots=True)
+class ChatReply:
+    text: str
+    thread_id: Optional[str] = None
+
+    @classmethod
+    def from_json(cls, data: dict, starts_thread: bool = False) -> 'ChatReply':
+        """starts_thread requires the thread_id, the next messages of the conversation are sent to it"""
+        thread_id = _require(data, 'thread_id', 'ChatReply') if starts_thread else data.get('thread_id')
+        return cls(text=_require(data, 'text', 'ChatReply'), thread_id=thread_id)
+
+
+@dataclass(slots=True)
+class AssistantMessage:
+    id: int
+    message: str
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'AssistantMessage':
+        return cls(id=_require(data, 'id', 'AssistantMessage'), message=_require(data, 'message', 'AssistantMessage'))
+
+
+@traced('backend')
+async def get_profile(user_email: str, client: httpx.AsyncClient, refresh: bool = False) -> Profile:
+    """Served from the lookup cache unless refresh is set"""
+
+    cached = None if refresh else lookup_cache.get(user_email, 'profile')
+    if cached is not None:
+        return Profile(**cached)
+    generation = lookup_cache.generation()
+    response = await hedged_get(client, f'{BACKEND_API_ENDPOINT}/profiles/email/{user_email}', endpoint='profile_by_email', headers=HEADERS)
+    profile = Profile.from_json(decode(response))
+    lookup_cache.put(user_email, since=generation, profile={'preferred_lang': profile.preferred_lang, 'name': profile.name, 'tg_username': profile.tg_username})
+    return profile
+
+@traced('backend')
+async def get_user(user_email: str, client: httpx.AsyncClient, refresh: bool = False) -> User:
+    """Served from the lookup cache unless refresh is set"""
+
+    cached = None if refresh else lookup_cache.get(user_email, 'user')
+    if cached is not None:
+        return User(**cached)
+    generation = lookup_cache.generation()
+    response = await hedged_get(client, f'{BACKEND_API_ENDPOINT}/users/email/{user_email}', endpoint='user_by_email', headers=HEADERS)
+    user = User.from_json(decode(response))
+    lookup_cache.put(user_email, since=generation, user={'id': user.id, 'email': user.email})
+    return user
+
+async def refresh_lookups(user_email: str, client: httpx.AsyncClient) -> None:
+    """Fetches the cached lookups of the user again, a user that is gone is dropped from the cache"""
+
+    try:
+        await get_user(user_email, client, refresh=True)
+        await get_profile(user_email, client, refresh=True)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != 404:
+            raise
+        lookup_cache.invalidate(user_email)
+
+@traced('backend')
+async def start_chat(user_email: str, client: httpx.AsyncClient) -> ChatReply:
+    response = await client.get(f'{BACKEND_API_ENDPOINT}/chat/{user_email}/start', headers=HEADERS, timeout=CHAT_TIMEOUT)
+    return ChatReply.from_json(decode(response), starts_thread=True)
+
+@traced('backend')
+async def send_chat_message(user_email: str, thread_id: str, text: str, client: httpx.AsyncClient) -> ChatReply:
+    response = await client.get(f'{BACKEND_API_ENDPOINT}/chat/{user_email}/message/{thread_id}', headers=HEADERS, timeout=CHAT_TIMEOUT, params={'text': text})
+    return ChatReply.from_json(decode(response))
+
+@traced('backend')
+async def complete_chat(user_email: str, client: httpx.AsyncClient) -> ChatReply:
+    response = await client.get(f'{BACKEND_API_ENDPOINT}/chat/{user_email}/complete', headers=HEADERS, timeout=CHAT_TIMEOUT)
+    return ChatReply.from_json(decode(response))
+
+@traced('backend')
+async def greet(user_email: str, client: httpx.AsyncClient) -> str:
+    response = await client.get(f'{BACKEND_API_ENDPOINT}/chat/{user_email}/greet', headers=HEADERS, timeout=CHAT_TIMEOUT)
+    return decode(response)
+
+@traced('backend')
+async def get_daily_advice(user_email: str, greeting: str, notes: str, level: int, client: httpx.AsyncClient) -> ChatReply:
+    response = await client.get(f'{BACKEND_API_ENDPOINT}/chat/{user_email}/daily_advice', headers=HEADERS, timeout=CHAT_TIMEOUT, params={
+        'greeting': greeting,
+        'user_notes': notes,
+        'overall_feeling_level': level
+    })
+    return ChatReply.from_json(decode(response), starts_thread=True)
+
+@traced('backend')
+async def get_initial_advice_piece_count(user_email: str, client: httpx.AsyncClient) -> int:
+    response = await hedged_get(client, f'{BACKEND_API_ENDPOINT}/initial_advice_piece_count/{user_email}', endpoint='initial_advice_piece_count', headers=HEADERS)
+    return int(decode(response))
+
+@traced('backend')
+async def get_initial_advice_piece(user_email: str, client: httpx.AsyncClient) -> ChatReply:
+    response = await client.get(f'{BACKEND_API_ENDPOINT}/initial_advice_piece/{user_email}', headers=HEADERS)
+    return ChatReply.from_json(decode(response))
+
+@traced('backend')
+async def list_assistant_messages(user_email: str, client: httpx.AsyncClient) -> Iterator[AssistantMessage]:
+    """Returns the last assistant messages, models are built lazily while iterating so a search can stop early"""
+    response = await hedged_get(client, f'{BACKEND_API_ENDPOINT}/users/{user_email}/assistant_messages', endpoint='assistant_messages', headers=HEADERS)
+    return (AssistantMessage.from_json(item) for item in decode(response))
+
+@traced('backend')
+async def create_assistant_message(user_email: str, text: str, thread_id: str, client: httpx.AsyncClient) -> None:
+    """Saves a message sent by the assistant through the API"""
+
+    message_json = {
+        'text': text,
+        'thread_id': thread_id,
+    }
+    response = await client.post(f'{BACKEND_API_ENDPOINT}/users/{user_email}/assistant_messages', headers=HEADERS, json=message_json, timeout=WRITE_TIMEOUT)
+    response.raise_for_status()
+
+def _comparable(text: str) -> str:
+    return ' '.join(clean_text(text).split())
+
+@traced('backend')
+async def save_message_feedback(user_email: str, message_text: str, feedback_field: str, client: httpx.AsyncClient) -> None:
+    """
+    Finds the assistant message by its text and sets the feedback field (positive_feedback or negative_feedback).
+    A long message saved by the API is sent in several parts with the feedback buttons on the last one, so it is found by its end.
+    """
+
+    # list last 50 assistant messages and get the id of the message (search for the message_text)
+    message_id = None
+    cleaned_text = _comparable(message_text)
+    for message in await list_assistant_messages(user_email, client):
+        stored_text = _comparable(message.message)
+        if stored_text == cleaned_text or stored_text.endswith(f' {cleaned_text}'):
+            message_id = message.id
+            break
+    if message_id is None:
+        # the message itself may still be waiting in the outbox
+        raise MessageNotFound(f"Message {message_text} was not found in the assistant messages")
+
+    response = await client.patch(f'{BACKEND_API_ENDPOINT}/users/{user_email}/assistant_messages/{message_id}', headers=HEADERS, json={feedback_field: True}, timeout=WRITE_TIMEOUT)
+    response.raise_for_status()
@@ -1,7 +1,7 @@
 import asyncio
 import logging
-import os, sys
-import traceback
+import os
+from typing import Any, Awaitable, Callable, Optional
 
 from aiogram import Bot, Dispatcher, html, F
 from aiogram.client.default import DefaultBotProperties
@@ -12,6 +12,7 @@ from aiogram.types import (
     Message,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
+    InlineKeyboardMarkup,
     CallbackQuery
 )
 import httpx
@@ -21,35 +22,51 @@ from aiogram.fsm.storage.redis import RedisStorage
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.jobstores.redis import RedisJobStore
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.storage.base import StorageKey
 from apscheduler_di import ContextSchedulerDecorator
 
 from translated_messages import MESSAGES_DICT
-from utils import RegistrationStates, DailyCheckStates, get_lang_keyboard, get_sex_keyboard, get_level_keyboard, get_mass_options_keyboard, get_height_options_keyboard, get_inline_feedback_buttons, clean_text
-from utils import check_extract_lang, eats_choice_handler, validated_past_date, generate_dummy_email
-from to_api_utils import save_user_form, set_profile_fields, get_async_client, BACKEND_API_ENDPOINT, HEADERS
-from voice import voice_to_text, clean_audio_file
-
-import sentry_sdk
-
-sentry_sdk.init(
-    dsn="https://15b32d6e56f608bdc118a5329f4e8969@o4507735707615232.ingest.us.sentry.io/4507735720263680",
-    # Set traces_sample_rate to 1.0 to capture 100%
-    # of transactions for performance monitoring.
-    traces_sample_rate=1.0,
-    # Set profiles_sample_rate to 1.0 to profile 100%
-    # of sampled transactions.
-    # We recommend adjusting this value in production.
-    profiles_sample_rate=1.0,
-)
+from utils import RegistrationStates, DailyCheckStates, get_lang_keyboard, get_sex_keyboard, get_level_keyboard, get_mass_options_keyboard, get_height_options_keyboard, get_inline_feedback_buttons
+from utils import check_extract_lang, eats_choice_handler, validated_past_date, generate_dummy_email, extract_external_id
+from to_api_utils import save_user_form, commit_registration, get_async_client, BACKEND_LIMITER
+from backend import refresh_lookups, get_profile, get_user, start_chat, send_chat_message, complete_chat, greet, get_daily_advice, get_initial_advice_piece_count, get_initial_advice_piece
+from voice import voice_to_text, clean_audio_file, preload_local_engine, DEEPGRAM_LIMITER
+from vad import NoSpeechDetected
+from spool import AudioSpool
+from coalescing import MessageCoalescer
+from admission import AdmissionController, Overloaded, CHAT_STATS_INTERVAL
+from redis_pool import get_redis, get_sync_redis
+from logging_setup import setup_logging, LoggingContextMiddleware
+from outbox import OutboxConsumer
+from telegram_text import split_message
+from dedup import UpdateDeduplicationMiddleware
+from advice_events import AdviceEventConsumer, push_mode as advice_push_mode
+import outbox
+from greetings import pregenerate_greetings, pop_cached_greeting, due_telegram_ids, GREETING_PREGEN_INTERVAL, GREETING_PREGEN_LEAD, GREETING_PREGEN_MAX_LOAD
+from loop_monitor import LoopMonitor
+from leases import leased, check_lease
+from fsm_cache import CachedRedisStorage
+from capture import TrafficCaptureMiddleware, capture_enabled
+from telegram_api import create_session, local_mode as telegram_local_mode
+from priority import PriorityLimiter, PriorityRequestMiddleware, batch_job, report_stats as report_lane_stats
+import lookup_cache
+from tracing import setup_sentry, traced_job, TracingMiddleware, TelegramSpanMiddleware, TracedStorage
+
+setup_sentry()
 
 TOKEN = os.getenv('TG_BOT_TOKEN')
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-storage = MemoryStorage()
+# Bot API calls running at once, and how many of them scheduled jobs can't take
+TELEGRAM_MAX_CONCURRENT = int(os.getenv('TELEGRAM_MAX_CONCURRENT', 20))
+TELEGRAM_INTERACTIVE_RESERVED = int(os.getenv('TELEGRAM_INTERACTIVE_RESERVED', 6))
+TELEGRAM_LIMITER = PriorityLimiter('telegram', TELEGRAM_MAX_CONCURRENT, TELEGRAM_INTERACTIVE_RESERVED)
+
+bot = Bot(token=TOKEN, session=create_session(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+bot.session.middleware(TelegramSpanMiddleware())
+bot.session.middleware(PriorityRequestMiddleware(TELEGRAM_LIMITER))
 
 JOBSTORES = {
-    'default': RedisJobStore(jobs_key='jobs', run_times_key='run_times', host='localhost', port=6379)
+    # the job store is synchronous, so it gets the sync pool built from the same Redis settings
+    'default': RedisJobStore(jobs_key='jobs', run_times_key='run_times', connection_pool=get_sync_redis().connection_pool)
 }
 
 UPDATE_INTERVAL = 60 * 5
@@ -58,14 +75,140 @@ scheduler = ContextSchedulerDecorator(AsyncIOScheduler(jobstores=JOBSTORES))
 scheduler.ctx.add_instance(bot, Bot)
 
 # All handlers should be attached to the Router (or Dispatcher)
-redis_storage = RedisStorage.from_url('redis://localhost:6379')
-dp = Dispatcher(storage=redis_storage)
+redis_storage = RedisStorage(redis=get_redis())
+# repeated reads of one conversation are served from memory
+fsm_storage = CachedRedisStorage(redis_storage)
+dp = Dispatcher(storage=TracedStorage(fsm_storage))
+dp.update.outer_middleware(TracingMiddleware())
+dp.update.outer_middleware(UpdateDeduplicationMiddleware())
+if capture_enabled():
+    dp.update.outer_middleware(TrafficCaptureMiddleware())
+dp.message.middleware(LoggingContextMiddleware())
+dp.callback_query.middleware(LoggingContextMiddleware())
+
+# Rapid consecutive messages of one user are answered with one LLM call
+coalescer = MessageCoalescer()
+# Concurrency limits with load shedding for the LLM-backed chat endpoints
+chat_admission = AdmissionController()
+
+# Background services started by main, referenced here so that they are not garbage collected
+background_tasks: set[asyncio.Task] = set()
+# Pause before a failed background service is started again, seconds
+BACKGROUND_RESTART_DELAY = float(os.getenv('BACKGROUND_RESTART_DELAY', 5.0))
+
+def start_background(name: str, make_coro: Callable[[], Awaitable[Any]], restart: bool = True) -> asyncio.Task:
+    """Runs the coroutine in a background task, a failure is logged and the coroutine is started again unless restart is False"""
+
+    async def supervise() -> None:
+        while True:
+            try:
+                await make_coro()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Background task {name} failed: {e}", exc_info=True)
+                if not restart:
+                    return
+            await asyncio.sleep(BACKGROUND_RESTART_DELAY)
+
+    task = asyncio.create_task(supervise(), name=name)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 # Bot can understand text and voice messages
 SUPPORTED_CONTENT_TYPES = ['text', 'voice']
-# mkdir files
-if not os.path.exists('files'):
-    os.makedirs('files')
+# Users being saved in the background while they go through onboarding, by telegram id
+pending_registrations: dict[int, asyncio.Task] = {}
+# Finished background saves are kept this long for the end of onboarding, then dropped, seconds
+PENDING_REGISTRATION_TTL = float(os.getenv('PENDING_REGISTRATION_TTL', 60 * 60))
+
+def get_registration_form(message: Message, preferred_lang: str) -> dict:
+    return {
+        'full_name': message.from_user.full_name,
+        'external_id': message.from_user.id,
+        'email': generate_dummy_email('tg', message.from_user.id),
+        'preferred_lang': preferred_lang,
+        'tg_username': message.from_user.username
+    }
+
+def start_pending_registration(telegram_id: int, registration_form: dict) -> None:
+    """Saves the user in the background, replacing an earlier save of the same user"""
+
+    cancel_pending_registration(telegram_id)
+    task = asyncio.create_task(save_user_in_background(registration_form))
+    pending_registrations[telegram_id] = task
+    # users who abandon onboarding don't leave their tasks behind
+    task.add_done_callback(lambda task: asyncio.get_running_loop().call_later(PENDING_REGISTRATION_TTL, forget_pending_registration, telegram_id, task))
+
+def forget_pending_registration(telegram_id: int, task: asyncio.Task) -> None:
+    if pending_registrations.get(telegram_id) is task:
+        del pending_registrations[telegram_id]
+
+def cancel_pending_registration(telegram_id: int) -> None:
+    task = pending_registrations.pop(telegram_id, None)
+    if task is not None:
+        task.cancel()
+
+async def save_user_in_background(registration_form: dict) -> Optional[tuple[Optional[int], bool]]:
+    """Saves the user, returns None on errors so that the commit at the end of onboarding saves it again"""
+
+    try:
+        async with get_async_client() as client:
+            return await save_user_form(registration_form=registration_form, client=client)
+    except Exception as e:
+        logging.warning(f"Could not save the user in the background: {e}")
+        return None
+
+async def send_assistant_text(chat_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, user_email: Optional[str] = None, thread_id: Optional[str] = None) -> None:
+    """
+    Sends a text generated by the assistant, rendered to Telegram HTML and split to fit the message limit.
+    The reply markup goes on the last message only. With user_email every message is saved as an assistant message as it is sent,
+    so that the feedback on it finds its text.
+    """
+
+    chunks = split_message(text)
+    for i, (chunk, html) in enumerate(chunks):
+        if user_email is not None:
+            await outbox.enqueue('assistant_message', user_email=user_email, text=chunk, thread_id=thread_id)
+        await bot.send_message(chat_id=chat_id, text=html, parse_mode=ParseMode.HTML, reply_markup=reply_markup if i == len(chunks) - 1 else None)
+
+# Working files for voice messages
+audio_spool = AudioSpool()
+
+async def remove_local_file(file_name: str) -> None:
+    try:
+        await clean_audio_file(file_name)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.warning(f"Could not remove {file_name} of the Bot API server: {e}")
+
+async def transcribe_voice(message: Message, preferred_lang: str) -> Optional[str]:
+    """
+    Transcribes the voice message. With a local Bot API server the file is read where the server saved it,
+    otherwise it is downloaded to the audio spool; the file is removed in any case.
+    Returns None after telling the user if there is no speech in the message.
+    """
+
+    file_id = message.voice.file_id
+    file = await bot.get_file(file_id)
+    try:
+        if telegram_local_mode():
+            file_name = str(bot.session.api.wrap_local_file.to_local(file.file_path))
+            try:
+                return await voice_to_text(file_name, preferred_lang, duration=message.voice.duration)
+            finally:
+                # the server doesn't delete the files it downloads in local mode
+                await remove_local_file(file_name)
+        async with audio_spool.file(f"{file_id}.mp3", size=file.file_size or 0) as file_name:
+            await bot.download_file(file.file_path, file_name)
+            return await voice_to_text(file_name, preferred_lang, duration=message.voice.duration)
+    except NoSpeechDetected as e:
+        logging.info(f"Voice message without speech: {e}")
+        await message.answer(MESSAGES_DICT['no_speech'][preferred_lang])
+        return None
     
 # <<<--->>>
 # HANDLERS
@@ -76,6 +219,8 @@ async def command_start_handler(message: Message, state: FSMContext) -> None:
     This handler receives messages with `/start` command
     """
     
+    # onboarding starts over, the user is saved again once the language is chosen
+    cancel_pending_registration(message.from_user.id)
     await state.set_state(RegistrationStates.language)
     message_text = f"Hello, {html.bold(message.from_user.full_name)}! Please, chose a language:"
     await message.answer(message_text, reply_markup = get_lang_keyboard())
@@ -92,16 +237,8 @@ async def process_lang(message: Message, state: FSMContext) -> None:
 
     if preferred_lang:
 
-        # save the user to the database
-        user_data = {
-            'full_name': message.from_user.full_name,
-            'external_id': message.from_user.id,
-            'preferred_lang': preferred_lang,
-            'tg_username': message.from_user.username
-        }
-
-        async with get_async_client() as client:
-            await save_user_form(registration_form=user_data, client=client)
+        # save the user to the database in the background, the result is awaited when the profile is committed
+        start_pending_registration(message.from_user.id, get_registration_form(message, preferred_lang))
 
         await state.update_data(preferred_lang=preferred_lang)
         # get the current state
@@ -333,14 +470,9 @@ async def process_description(message: Message, state: FSMContext) -> None:
         
     elif message.content_type == 'voice':
         
-        file_id = message.voice.file_id  
-        file = await bot.get_file(file_id)  
-        file_path = file.file_path  
-        file_name = f"files/audio{file_id}.mp3"
-        await bot.download_file(file_path, file_name)
-        
-        transcription = await voice_to_text(file_name, preferred_lang)
-        await clean_audio_file(f"files/audio{file_id}.mp3")
+        transcription = await transcribe_voice(message, preferred_lang)
+        if transcription is None:
+            return
         await state.update_data(description=transcription)
         
     await state.set_state(RegistrationStates.completed)
@@ -379,7 +511,7 @@ async def all_saved(message: Message, state: FSMContext) -> None:
                 'description': data['description']
             }
         except Exception as e:
-            logging.error(f"Error while parsing the profile: {e}. More info:\n {traceback.format_exc()}")
+            logging.error(f"Error while parsing the profile: {e}", exc_info=True)
             await state.set_state(RegistrationStates.language)
             # REMOVE SHOWING ERROR MESSAGE IN PRODUCTION
             await message.answer(f'An error occurred while parsing the profile data. Probably, you have a typo in mass or height.\n\nPlease, try again. Choose a language:', reply_markup = get_lang_keyboard())
@@ -387,13 +519,15 @@ async def all_saved(message: Message, state: FSMContext) -> None:
 
     # TODO ability to skip height and mass (person may not know it)
 
-    email = generate_dummy_email('tg', message.from_user.id)
+    # the user may have been saved in the background by another instance or before a restart, then it is saved here
+    registration = pending_registrations.pop(message.from_user.id, None)
+    saved_user = await registration if registration is not None else None
 
     try:
         async with get_async_client() as client:
-            await set_profile_fields(profile_fields=profile_data, user_email=email, client=client)
+            await commit_registration(registration_form=get_registration_form(message, data['preferred_lang']), profile_fields=profile_data, client=client, saved_user=saved_user)
     except Exception as e:
-        logging.error(f"Error while saving the profile: {e}. More info:\n {traceback.format_exc()}")
+        logging.error(f"Error while saving the profile: {e}", exc_info=True)
         await state.set_state(RegistrationStates.language)
         # REMOVE SHOWING ERROR MESSAGE IN PRODUCTION
         await message.answer(f'An error occurred while saving the profile data. Probably, you have a typo in mass or height\n\nPlease, try again. Choose a language:', reply_markup = get_lang_keyboard())
@@ -401,8 +535,8 @@ async def all_saved(message: Message, state: FSMContext) -> None:
 
     preferred_lang = data['preferred_lang']
     await message.answer(MESSAGES_DICT['completed'][preferred_lang], reply_markup=ReplyKeyboardRemove())
+    # moves to consulting once the consultation is started, otherwise the next message tries again
     await initial_consultation(message, state)
-    await state.set_state(RegistrationStates.consulting)
 
 
 @dp.message(RegistrationStates.completed)
@@ -417,61 +551,37 @@ async def initial_consultation(message: Message, state: FSMContext) -> None:
         email = generate_dummy_email('tg', user_id)
 
         async with get_async_client() as client:
-            response = await client.get(f'{BACKEND_API_ENDPOINT}/profiles/email/{email}', headers=HEADERS)
-        preferred_lang = response.json()['preferred_lang']
+            preferred_lang = (await get_profile(email, client)).preferred_lang
         
         # send typing action
         await message.bot.send_chat_action(chat_id=message.chat.id, action='typing')
         
         async with get_async_client() as client:
             
-            response = await client.get(f'{BACKEND_API_ENDPOINT}/users/email/{email}', headers=HEADERS)
-            response.raise_for_status()
-            user_email = response.json()['email']
-            
-            response = await client.get(f'{BACKEND_API_ENDPOINT}/chat/{user_email}/start', headers=HEADERS)
-            response.raise_for_status()
-            thread_id = response.json()['thread_id']
-            raw_text = response.json()['text']
+            user_email = (await get_user(email, client)).email
             
-            response = await client.get(f'{BACKEND_API_ENDPOINT}/chat/{user_email}/split', headers=HEADERS, params={'advice': raw_text})
-            response.raise_for_status()
-            message_text = response.json()['text']            
+            async with chat_admission.admit(user_id):
+                reply = await start_chat(user_email, client)
+                thread_id = reply.thread_id
+                raw_text = reply.text
 
         await state.update_data(thread_id=thread_id)
         await state.update_data(preferred_lang=preferred_lang)
-        
-        # Create assistant message
-        async with get_async_client() as client:
-            messsage_json = {
-                'text': message_text,
-                'thread_id': thread_id,
-            }
-            response = await client.post(f'{BACKEND_API_ENDPOINT}/users/{user_email}/assistant_messages', headers=HEADERS, json=messsage_json)
-            response.raise_for_status()
-        
         await state.set_state(RegistrationStates.consulting)
         
-        # Create assistant message
-        async with get_async_client() as client:
-            message_json = {
-                'text': message_text,
-                'thread_id': thread_id,
-            }
-            response = await client.post(f'{BACKEND_API_ENDPOINT}/users/{user_email}/assistant_messages', headers=HEADERS, json=message_json)
-            response.raise_for_status()
-        
-        await message.answer(
-            text=message_text,
-            reply_markup=get_inline_feedback_buttons(preferred_lang),
-            parse_mode=ParseMode.MARKDOWN
-        )
+        # Create assistant messages
+        await send_assistant_text(message.chat.id, raw_text, reply_markup=get_inline_feedback_buttons(preferred_lang), user_email=user_email, thread_id=thread_id)
         
-        # Send regular messages to this user
-        scheduler.add_job(send_daily_initial_piece, 'interval', seconds=UPDATE_INTERVAL, kwargs={'telegram_id': message.from_user.id}, id=f'{message.from_user.id}_initial_consultation', replace_existing=True)
+        # Send regular messages to this user, in push mode they are sent when the API publishes them
+        if not advice_push_mode():
+            scheduler.add_job(send_daily_initial_piece, 'interval', seconds=UPDATE_INTERVAL, kwargs={'telegram_id': message.from_user.id}, id=f'{message.from_user.id}_initial_consultation', replace_existing=True)
     
+    except Overloaded as e:
+        logging.warning(f"Initial consultation was shed: {e}")
+        await message.answer(MESSAGES_DICT['busy'][preferred_lang])
+
     except Exception as e:
-        logging.error(f"Error while starting the initial consultation: {e}. More info:\n {traceback.format_exc()}")
+        logging.error(f"Error while starting the initial consultation: {e}", exc_info=True, extra={'endpoint': 'chat/start'})
         await message.answer("An error occurred while starting the initial consultation. Please, try again later. Take into account that images or voice messages are not supported yet. Try to wake me up with /start command!")
 
     
@@ -492,14 +602,9 @@ async def consult(message: Message, state: FSMContext) -> None:
         
     elif message.content_type == 'voice':
         
-        file_id = message.voice.file_id  
-        file = await bot.get_file(file_id)  
-        file_path = file.file_path  
-        file_name = f"files/audio{file_id}.mp3"
-        await bot.download_file(file_path, file_name)
-        
-        transcription = await voice_to_text(file_name, preferred_lang)
-        await clean_audio_file(f"files/audio{file_id}.mp3")
+        transcription = await transcribe_voice(message, preferred_lang)
+        if transcription is None:
+            return
         message_text = transcription
     
     try:
@@ -508,8 +613,7 @@ async def consult(message: Message, state: FSMContext) -> None:
         user_email = generate_dummy_email('tg', message.from_user.id)
         # get thread_id and preferred_lang from the database
         async with get_async_client() as client:
-            response = await client.get(f'{BACKEND_API_ENDPOINT}/profiles/email/{user_email}', headers=HEADERS)
-            preferred_lang = response.json()['preferred_lang']
+            preferred_lang = (await get_profile(user_email, client)).preferred_lang
             thread_id = data['thread_id']
         
         # if message.text == MESSAGES_DICT['complete_consultation'][preferred_lang]:
@@ -529,21 +633,22 @@ async def consult(message: Message, state: FSMContext) -> None:
         # else:
         #     # continue the consultation
         #     # typing action
-        await message.bot.send_chat_action(chat_id=message.chat.id, action='typing')
-        async with get_async_client() as client:
-            response = await client.get(f'{BACKEND_API_ENDPOINT}/chat/{user_email}/message/{thread_id}', headers=HEADERS, params={'text': message_text})
-            response.raise_for_status()
-        message_text = response.json()['text']
-        
-        await message.answer(
-            text=message_text,
-            reply_markup=get_inline_feedback_buttons(preferred_lang),
-            parse_mode=ParseMode.MARKDOWN
-        )
+        async with coalescer.burst(message.from_user.id, message_text) as message_text:
+            if message_text is None:
+                # the message was merged into the pending request of this user
+                return
+            await message.bot.send_chat_action(chat_id=message.chat.id, action='typing')
+            async with chat_admission.admit(message.from_user.id), get_async_client() as client:
+                message_text = (await send_chat_message(user_email, thread_id, message_text, client)).text
+            
+            await send_assistant_text(message.chat.id, message_text, reply_markup=get_inline_feedback_buttons(preferred_lang))
             
+    except Overloaded as e:
+        logging.warning(f"Consultation message was shed: {e}")
+        await message.answer(MESSAGES_DICT['busy'][preferred_lang])
+
     except Exception as e:
-        logging.error(f"Error while sending the message: {e}. More info:\n {traceback.format_exc()}")
-        traceback.print_exc()
+        logging.error(f"Error while sending the message: {e}", exc_info=True, extra={'endpoint': 'chat/message'})
         await message.answer("An error occurred while sending the message. Please, try again later. You can also completely refill your profile with /start command!")
  
 @dp.callback_query(F.data == 'helpful_message')
@@ -556,24 +661,7 @@ async def save_feedback_good(call: CallbackQuery) -> None:
     
     await call.answer(MESSAGES_DICT['thanks_for_feedback']['en'])
     
-    # list last 50 assistant messages and get the id of the message that was helpful (search for the message_text)
-    async with get_async_client() as client:
-        response = await client.get(f'{BACKEND_API_ENDPOINT}/users/{user_email}/assistant_messages', headers=HEADERS)
-        response.raise_for_status()
-        messages = response.json()
-        message_id = None
-        for message in messages:
-            if clean_text(message['message']) == clean_text(message_text):
-                message_id = message['id']
-                break
-        if message_id is None:
-            # log warning and return
-            logging.warning(f"Message {message_text} was not found in the assistant messages")
-            return
-    
-        # patch the message with the feedback
-        response = await client.patch(f'{BACKEND_API_ENDPOINT}/users/{user_email}/assistant_messages/{message_id}', headers=HEADERS, json={'positive_feedback': True})
-        
+    await outbox.enqueue('feedback', user_email=user_email, message_text=message_text, feedback_field='positive_feedback')
     
 @dp.callback_query(F.data == 'not_helpful_message')
 async def save_feedback_bad(call: CallbackQuery) -> None:
@@ -585,23 +673,7 @@ async def save_feedback_bad(call: CallbackQuery) -> None:
     
     await call.answer(MESSAGES_DICT['thanks_for_feedback']['en'])
     
-    # list last 50 assistant messages and get the id of the message that was helpful (search for the message_text)
-    async with get_async_client() as client:
-        response = await client.get(f'{BACKEND_API_ENDPOINT}/users/{user_email}/assistant_messages', headers=HEADERS)
-        response.raise_for_status()
-        messages = response.json()
-        message_id = None
-        for message in messages:
-            if clean_text(message['message']) == clean_text(message_text):
-                message_id = message['id']
-                break
-        if message_id is None:
-            # log warning and return
-            logging.warning(f"Message {message_text} was not found in the assistant messages")
-            return
-    
-        # patch the message with the feedback
-        response = await client.patch(f'{BACKEND_API_ENDPOINT}/users/{user_email}/assistant_messages/{message_id}', headers=HEADERS, json={'negative_feedback': True})
+    await outbox.enqueue('feedback', user_email=user_email, message_text=message_text, feedback_field='negative_feedback')
 
 # @dp.message(F.text, Command('test'))
 # async def test(message: Message, state: FSMContext) -> None:
@@ -609,68 +681,128 @@ async def save_feedback_bad(call: CallbackQuery) -> None:
 #     scheduler.add_job(send_daily_check_message, 'interval', seconds=UPDATE_INTERVAL, kwargs={'telegram_id': message.from_user.id}, id=f'{message.from_user.id}_test', replace_existing=True)
 #     await message.answer("Test job is scheduled")
 
+async def generate_greeting(telegram_id: int) -> str:
+    """Generates a daily check greeting for the user through the API"""
+
+    user_email = generate_dummy_email('tg', telegram_id)
+    async with chat_admission.admit(telegram_id), get_async_client() as client:
+        return await greet(user_email, client)
+
+@leased(GREETING_PREGEN_INTERVAL)
+@traced_job
+@batch_job
+async def pregenerate_daily_greetings() -> None:
+    """Generates greetings ahead of time for the daily checks that are due soon, while the chat endpoints are off-peak"""
+
+    load = chat_admission.interactive_load()
+    if load > GREETING_PREGEN_MAX_LOAD:
+        # the daily checks due meanwhile generate their greetings at delivery
+        logging.info(f"Skipping greeting pre-generation, chat load is {load:.0%}")
+        return
+    # the lead stays below the delivery interval, otherwise every greeting would be prepared again right after it is sent
+    lead = min(GREETING_PREGEN_LEAD, UPDATE_INTERVAL - GREETING_PREGEN_INTERVAL)
+    # the jobstore is read synchronously
+    jobs = await asyncio.to_thread(scheduler.get_jobs)
+    await pregenerate_greetings(due_telegram_ids(jobs, lead), generate_greeting)
+
+@leased(UPDATE_INTERVAL)
+@traced_job
+@batch_job
 async def send_daily_check_message(telegram_id: str, bot: Bot = None) -> None:
     """Sends a daily check message to the user"""
 
-    user_email = generate_dummy_email('tg', telegram_id)
-    async with get_async_client() as client:
-        response = await client.get(f'{BACKEND_API_ENDPOINT}/chat/{user_email}/greet', headers=HEADERS)
-        response.raise_for_status()
-    message_text = response.json()
+    message_text = await pop_cached_greeting(telegram_id)
+    if message_text is None:
+        try:
+            message_text = await generate_greeting(telegram_id)
+        except Overloaded as e:
+            # the job will run again on the next interval
+            logging.warning(f"Daily check message for {telegram_id} was shed: {e}")
+            return
 
+    await check_lease()
     # change state to waiting_for_level
     key = StorageKey(bot.id, telegram_id, telegram_id)
     user_context = FSMContext(dp.storage, key)
     await user_context.set_state(DailyCheckStates.waiting_for_notes)
     await user_context.update_data(greeting=message_text)
-    await bot.send_message(chat_id=telegram_id, text=message_text)
+    await send_assistant_text(telegram_id, message_text)
     
-async def send_daily_initial_piece(telegram_id: str, bot: Bot = None) -> None:
-    """Sends a daily piece of advice on the initial stage"""
+async def complete_initial_consultation(telegram_id: int, bot: Bot) -> str:
+    """Completes the initial consultation and switches the user to daily checks, returns the final message"""
+
+    user_email = generate_dummy_email('tg', telegram_id)
+    await check_lease()
+    async with chat_admission.admit(telegram_id), get_async_client() as client:
+        reply = await complete_chat(user_email, client)
     
+    # set the state to initial_consultation_completed
+    key = StorageKey(bot.id, telegram_id, telegram_id)
+    user_context = FSMContext(dp.storage, key)
+    await user_context.set_state(RegistrationStates.initial_consultation_completed)
+    
+    # remove the polling job
+    if scheduler.get_job(f'{telegram_id}_initial_consultation') is not None:
+        scheduler.remove_job(f'{telegram_id}_initial_consultation')
+    
+    # add the daily check job
+    scheduler.add_job(send_daily_check_message, 'interval', seconds=UPDATE_INTERVAL, kwargs={'telegram_id': telegram_id}, id=f'{telegram_id}_daily_check', replace_existing=True)
+    return reply.text
+
+async def fetch_initial_piece(telegram_id: int) -> str:
     user_email = generate_dummy_email('tg', telegram_id)
     async with get_async_client() as client:
-        response = await client.get(f'{BACKEND_API_ENDPOINT}/initial_advice_piece_count/{user_email}', headers=HEADERS)
-        response.raise_for_status()
-        number_of_pieces = int(response.json())
-        if number_of_pieces == 0:
-            
-            # complete the initial consultation
-            response = await client.get(f'{BACKEND_API_ENDPOINT}/chat/{user_email}/complete', headers=HEADERS)
-            response.raise_for_status()
-            
-            # set the state to initial_consultation_completed
-            key = StorageKey(bot.id, telegram_id, telegram_id)
-            user_context = FSMContext(dp.storage, key)
-            await user_context.set_state(RegistrationStates.initial_consultation_completed)
-            
-            # remove the job
-            scheduler.remove_job(f'{telegram_id}_initial_consultation')
-            
-            # add the daily check job
-            scheduler.add_job(send_daily_check_message, 'interval', seconds=UPDATE_INTERVAL, kwargs={'telegram_id': telegram_id}, id=f'{telegram_id}_daily_check', replace_existing=True)
-            
-        else:
-            response = await client.get(f'{BACKEND_API_ENDPOINT}/initial_advice_piece/{user_email}', headers=HEADERS)
-            response.raise_for_status()
-        
-    message_text = response.json()['text']
+        return (await get_initial_advice_piece(user_email, client)).text
+
+async def deliver_initial_piece(telegram_id: int, message_text: str, bot: Bot) -> None:
+    """Saves and sends a piece of advice on the initial stage"""
+
+    user_email = generate_dummy_email('tg', telegram_id)
     async with get_async_client() as client:
-        response = await client.get(f'{BACKEND_API_ENDPOINT}/profiles/email/{user_email}', headers=HEADERS)
-    preferred_lang = response.json()['preferred_lang']
-    data = await user_context.get_data()
+        preferred_lang = (await get_profile(user_email, client)).preferred_lang
+    key = StorageKey(bot.id, telegram_id, telegram_id)
+    data = await FSMContext(dp.storage, key).get_data()
     thread_id = data['thread_id']
     
-    # Create assistant message
-    async with get_async_client() as client:
-        messsage_json = {
-            'text': message_text,
-            'thread_id': thread_id,
-        }
-        response = await client.post(f'{BACKEND_API_ENDPOINT}/users/{user_email}/assistant_messages', headers=HEADERS, json=messsage_json)
-        response.raise_for_status()
+    await check_lease()
+    # Create assistant messages
+    await send_assistant_text(telegram_id, message_text, reply_markup=get_inline_feedback_buttons(preferred_lang), user_email=user_email, thread_id=thread_id)
+
+@leased(UPDATE_INTERVAL)
+@traced_job
+@batch_job
+async def send_daily_initial_piece(telegram_id: str, bot: Bot = None) -> None:
+    """Sends a daily piece of advice on the initial stage, polling the API for the number of pieces left"""
     
-    await bot.send_message(chat_id=telegram_id, text=message_text, parse_mode=ParseMode.MARKDOWN, reply_markup=get_inline_feedback_buttons(preferred_lang))
+    user_email = generate_dummy_email('tg', telegram_id)
+    async with get_async_client() as client:
+        number_of_pieces = await get_initial_advice_piece_count(user_email, client)
+
+    if number_of_pieces == 0:
+        try:
+            message_text = await complete_initial_consultation(telegram_id, bot)
+        except Overloaded as e:
+            # the job will run again on the next interval
+            logging.info(f"Completion of the initial consultation for {telegram_id} was shed: {e}")
+            return
+    else:
+        message_text = await fetch_initial_piece(telegram_id)
+    await deliver_initial_piece(telegram_id, message_text, bot)
+
+@traced_job
+@batch_job
+async def on_advice_ready(telegram_id: int, message_text: Optional[str]) -> None:
+    """Push mode: a new piece of advice is ready for the user"""
+    if message_text is None:
+        message_text = await fetch_initial_piece(telegram_id)
+    await deliver_initial_piece(telegram_id, message_text, bot)
+
+@traced_job
+@batch_job
+async def on_consultation_complete(telegram_id: int, message_text: Optional[str]) -> None:
+    """Push mode: there are no pieces of advice left for the user, a shed completion is retried by the stream consumer"""
+    message_text = await complete_initial_consultation(telegram_id, bot)
+    await deliver_initial_piece(telegram_id, message_text, bot)
 
 
 @dp.message(DailyCheckStates.waiting_for_level)
@@ -695,22 +827,22 @@ async def daily_check(message: Message, state: FSMContext) -> None:
     greeting = data['greeting']
     
     
-    async with get_async_client() as client:
-        response = await client.get(f'{BACKEND_API_ENDPOINT}/chat/{user_email}/daily_advice', headers=HEADERS, params={
-            'greeting': greeting,
-            'user_notes': notes,
-            'overall_feeling_level': level
-        })
-        response.raise_for_status()
+    try:
+        async with chat_admission.admit(message.from_user.id), get_async_client() as client:
+            reply = await get_daily_advice(user_email, greeting, notes, level, client)
+    except Overloaded as e:
+        logging.warning(f"Daily advice was shed: {e}")
+        await message.answer(MESSAGES_DICT['busy'][preferred_lang], reply_markup=get_level_keyboard(preferred_lang))
+        return
         
-    thread_id = response.json()['thread_id']
-    message_text = response.json()['text']
+    thread_id = reply.thread_id
+    message_text = reply.text
     
     # update state with thread_id
     await state.update_data(thread_id=thread_id)
     
     await state.set_state(RegistrationStates.initial_consultation_completed)
-    await message.answer(message_text, parse_mode=ParseMode.MARKDOWN, reply_markup=get_inline_feedback_buttons(preferred_lang))
+    await send_assistant_text(message.chat.id, message_text, reply_markup=get_inline_feedback_buttons(preferred_lang))
 
 @dp.message(DailyCheckStates.waiting_for_notes)
 async def daily_check_notes(message: Message, state: FSMContext) -> None:
@@ -723,8 +855,7 @@ async def daily_check_notes(message: Message, state: FSMContext) -> None:
     await state.update_data(notes=notes)
     
     async with get_async_client() as client:
-        response = await client.get(f'{BACKEND_API_ENDPOINT}/profiles/email/{user_email}', headers=HEADERS)
-    preferred_lang = response.json()['preferred_lang']
+        preferred_lang = (await get_profile(user_email, client)).preferred_lang
     
     # update state with preferred_lang and greeting
     await state.update_data(preferred_lang=preferred_lang)
@@ -745,24 +876,16 @@ async def default_answer(message: Message, state: FSMContext) -> None:
     # Get preferred_lang from the database instead of state
     user_email = generate_dummy_email('tg', message.from_user.id)
     async with get_async_client() as client:
-        response = await client.get(f'{BACKEND_API_ENDPOINT}/profiles/email/{user_email}', headers=HEADERS)
-    preferred_lang = response.json()['preferred_lang']
+        preferred_lang = (await get_profile(user_email, client)).preferred_lang
     
     if message.content_type == 'text':
         message_text = message.text
         
     elif message.content_type == 'voice':
         
-        # TODO DRY
-        
-        file_id = message.voice.file_id  
-        file = await bot.get_file(file_id)  
-        file_path = file.file_path  
-        file_name = f"files/audio{file_id}.mp3"
-        await bot.download_file(file_path, file_name)
-        
-        transcription = await voice_to_text(file_name, preferred_lang)
-        await clean_audio_file(f"files/audio{file_id}.mp3")
+        transcription = await transcribe_voice(message, preferred_lang)
+        if transcription is None:
+            return
         message_text = transcription
 
     data = await state.get_data()
@@ -776,26 +899,68 @@ async def default_answer(message: Message, state: FSMContext) -> None:
         # TODO: FIX check if thread_id is in the data and don't use it if it's not (start a new thread)
         await message.answer("An error occurred while sending the message. Please, try again later. You can also completely refill your profile with /start command!")
     
-    await message.bot.send_chat_action(chat_id=message.chat.id, action='typing')
+    # errors are handled outside the burst, so the messages merged into it get them too
     try:
-        async with get_async_client() as client:
-            response = await client.get(f'{BACKEND_API_ENDPOINT}/chat/{user_email}/message/{thread_id}', headers=HEADERS, params={'text': message_text})
-            response.raise_for_status()
+        async with coalescer.burst(message.from_user.id, message_text) as message_text:
+            if message_text is None:
+                # the message was merged into the pending request of this user
+                return
+
+            await message.bot.send_chat_action(chat_id=message.chat.id, action='typing')
+            async with chat_admission.admit(message.from_user.id), get_async_client() as client:
+                reply = await send_chat_message(user_email, thread_id, message_text, client)
+
+            await send_assistant_text(message.chat.id, reply.text, reply_markup=get_inline_feedback_buttons(preferred_lang))
+    except Overloaded as e:
+        logging.warning(f"Message was shed: {e}")
+        await message.answer(MESSAGES_DICT['busy'][preferred_lang])
     except Exception as e:
-        logging.error(f"Error while sending the message: {e}. More info:\n {traceback.format_exc()}")
+        logging.error(f"Error while sending the message: {e}", exc_info=True, extra={'endpoint': 'chat/message'})
         await message.answer("An error occurred while sending the message. Please, try again later. You can also completely refill your profile with /start command!")
-        return
-    
-    await message.answer(response.json()['text'], parse_mode=ParseMode.MARKDOWN, reply_markup=get_inline_feedback_buttons(preferred_lang))
+
+
+@batch_job
+async def revalidate_warm_user(user_email: str) -> None:
+    """Refreshes the lookups of a user loaded from the warm start snapshot, and their FSM state and data (thread_id) into the local cache"""
+
+    telegram_id = extract_external_id(user_email)
+    key = StorageKey(bot.id, telegram_id, telegram_id)
+    await fsm_storage.get_state(key)
+    await fsm_storage.get_data(key)
+    async with get_async_client() as client:
+        await refresh_lookups(user_email, client)
 
 
 async def main() -> None:
     # Initialize Bot instance with default bot properties which will be passed to all API calls
+    audio_spool.sweep()
+    start_background('preload_local_engine', preload_local_engine, restart=False)
     scheduler.start()
+    scheduler.add_job(pregenerate_daily_greetings, 'interval', seconds=GREETING_PREGEN_INTERVAL, id='pregenerate_daily_greetings', replace_existing=True)
+    start_background('loop_monitor', LoopMonitor().run)
+    start_background('fsm_invalidation', fsm_storage.listen)
+    start_background('admission_stats', chat_admission.report_stats)
+    start_background('lane_stats', lambda: report_lane_stats([BACKEND_LIMITER, DEEPGRAM_LIMITER, TELEGRAM_LIMITER], CHAT_STATS_INTERVAL))
+    start_background('outbox_consumer', OutboxConsumer().run)
+    if advice_push_mode():
+        start_background('advice_event_consumer', AdviceEventConsumer(on_advice_ready, on_consultation_complete).run)
+    # the lookups of the previous run serve the first updates, and are refreshed meanwhile
+    warm_users = await lookup_cache.load_snapshot()
+    start_background('lookup_invalidation', lookup_cache.listen)
+    start_background('warm_start_revalidation', lambda: lookup_cache.revalidate(warm_users, revalidate_warm_user), restart=False)
+    start_background('warm_start_snapshots', lookup_cache.snapshot_periodically)
     # And the run events dispatching
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        for task in list(background_tasks):
+            task.cancel()
+        # a service that swallows the cancellation must not hold up the shutdown snapshot
+        if background_tasks:
+            await asyncio.wait(list(background_tasks), timeout=BACKGROUND_RESTART_DELAY)
+        await lookup_cache.save_snapshot()
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    setup_logging(logging.INFO)
     asyncio.run(main())
@@ -0,0 +1,104 @@
+"""Capture of incoming updates for load replays: an append-only JSON lines file with users and texts anonymized."""
+
+from typing import Any, Awaitable, Callable, Optional
+from dotenv import load_dotenv
+
+import hashlib
+import hmac
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+import orjson
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from translated_messages import MESSAGES_DICT
+from utils import SUPPORTED_LANGS, get_lang_keyboard
+
+load_dotenv()
+
+# Updates are recorded to this file when it is set
+TRAFFIC_CAPTURE_PATH = os.getenv('TRAFFIC_CAPTURE_PATH')
+# Salt of the anonymized user ids, a random one makes ids differ between runs of the bot
+TRAFFIC_CAPTURE_SALT = os.getenv('TRAFFIC_CAPTURE_SALT') or os.urandom(16).hex()
+
+# Texts of the bot's own buttons and commands are kept, they decide which handler runs on replay
+KEPT_TEXTS = {message[lang] for message in MESSAGES_DICT.values() for lang in SUPPORTED_LANGS} | {button.text for button in get_lang_keyboard().keyboard[0]}
+
+
+def capture_enabled() -> bool:
+    return bool(TRAFFIC_CAPTURE_PATH)
+
+def anonymize_id(user_id: int) -> int:
+    digest = hmac.new(TRAFFIC_CAPTURE_SALT.encode(), str(user_id).encode(), hashlib.sha256).digest()
+    # positive and below 2**47, a valid Telegram id
+    return int.from_bytes(digest[:6], 'big') >> 1
+
+def anonymize_text(text: Optional[str]) -> Optional[str]:
+    """Keeps the length and the shape of the text: letters become x, digits become 0, except for short numbers"""
+
+    if text is None or text.startswith('/') or text in KEPT_TEXTS:
+        return text
+    # levels, mass and height answers
+    if text.isdigit() and len(text) <= 3:
+        return text
+    return re.sub(r'\d', '0', re.sub(r'[^\W\d_]', 'x', text))
+
+def capture_record(event: Update, raw_state: Optional[str]) -> Optional[dict]:
+    """Builds the record of an update, None for the kinds of updates the bot doesn't handle"""
+
+    if event.message is not None:
+        message = event.message
+        record = {'kind': 'message', 'user': anonymize_id(message.from_user.id), 'content': message.content_type}
+        if message.voice is not None:
+            record.update(duration=message.voice.duration, size=message.voice.file_size, mime=message.voice.mime_type)
+        else:
+            record['text'] = anonymize_text(message.text)
+    elif event.callback_query is not None:
+        callback = event.callback_query
+        record = {'kind': 'callback_query', 'user': anonymize_id(callback.from_user.id), 'data': callback.data}
+        if callback.message is not None:
+            record['text'] = anonymize_text(callback.message.text)
+    else:
+        return None
+    record['state'] = raw_state
+    return record
+
+
+class TrafficCaptureMiddleware(BaseMiddleware):
+    """
+    Outer middleware that appends every update to a JSON lines file with the time since the previous one.
+    Lines are written by a background thread, so the event loop never waits for the disk.
+    """
+
+    def __init__(self, path: str = TRAFFIC_CAPTURE_PATH):
+        self.path = path
+        self.lines: queue.SimpleQueue = queue.SimpleQueue()
+        self.last_arrival: Optional[float] = None
+        threading.Thread(target=self.write, name='traffic-capture', daemon=True).start()
+
+    def write(self) -> None:
+        with open(self.path, 'ab') as file:
+            while True:
+                line = self.lines.get()
+                file.write(line)
+                # other lines that are ready go out with the same flush
+                while not self.lines.empty():
+                    file.write(self.lines.get())
+                file.flush()
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]], event: Update, data: dict[str, Any]) -> Any:
+        now = time.monotonic()
+        try:
+            record = capture_record(event, data.get('raw_state'))
+            if record is not None:
+                record['dt'] = round(now - self.last_arrival, 3) if self.last_arrival is not None else 0.0
+                self.last_arrival = now
+                self.lines.put(orjson.dumps(record) + b'\n')
+        except Exception as e:
+            logging.warning(f"Could not capture update {event.update_id}: {e}")
+        return await handler(event, data)
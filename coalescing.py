@@ -0,0 +1,111 @@
+"""Coalescing of rapid consecutive user messages into a single LLM call."""
+
+from typing import Optional, AsyncIterator
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+
+import asyncio
+import os
+import time
+
+load_dotenv()
+
+# How long to wait for the next message of a burst, seconds
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', 1.5))
+# Upper bound on how long the first message of a burst can be delayed, seconds
+COALESCE_MAX_WAIT = float(os.getenv('COALESCE_MAX_WAIT', 5.0))
+# Upper bound on the number of messages merged into one call
+COALESCE_MAX_SIZE = int(os.getenv('COALESCE_MAX_SIZE', 5))
+
+
+class Burst:
+    """Messages of one user waiting to be sent as one request"""
+
+    def __init__(self, key: int):
+        self.key = key
+        self.texts: list[str] = []
+        self.started_at = time.monotonic()
+        self.updated = asyncio.Event()
+        self.closed = False
+        # set once the leader's request is over, with its error if it failed
+        self.done = asyncio.Event()
+        self.error: Optional[Exception] = None
+
+
+class MessageCoalescer:
+    """
+    Merges messages of the same user that arrive within a debounce window, or while a reply for this user is still pending.
+    The first message of a burst becomes the leader and makes the request for the whole burst,
+    the others wait for its outcome and get its error if it failed, so every message of the burst is answered.
+    """
+
+    def __init__(self, window: float = COALESCE_WINDOW, max_wait: float = COALESCE_MAX_WAIT, max_size: int = COALESCE_MAX_SIZE):
+        self.window = window
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self._bursts: dict[int, Burst] = {}
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._lock_users: dict[int, int] = {}
+
+    def _add(self, burst: Burst, text: str) -> None:
+        burst.texts.append(text)
+        if len(burst.texts) >= self.max_size:
+            self._close(burst)
+        burst.updated.set()
+
+    def _close(self, burst: Burst) -> None:
+        burst.closed = True
+        if self._bursts.get(burst.key) is burst:
+            del self._bursts[burst.key]
+
+    async def _debounce(self, burst: Burst) -> None:
+        deadline = burst.started_at + self.max_wait
+        while not burst.closed:
+            timeout = min(self.window, deadline - time.monotonic())
+            if timeout <= 0:
+                return
+            burst.updated.clear()
+            try:
+                await asyncio.wait_for(burst.updated.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return
+
+    @asynccontextmanager
+    async def burst(self, key: int, text: str) -> AsyncIterator[Optional[str]]:
+        """
+        Yields the merged text if the caller should send the request, None if the message was merged into another burst
+        and its request succeeded. If that request failed, its error is raised for the merged message too.
+        Requests of the same user are serialized, so replies don't interleave.
+        """
+
+        burst = self._bursts.get(key)
+        if burst is not None and not burst.closed:
+            self._add(burst, text)
+            await burst.done.wait()
+            if burst.error is not None:
+                raise burst.error
+            yield None
+            return
+
+        burst = Burst(key)
+        self._bursts[key] = burst
+        self._add(burst, text)
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._lock_users[key] = self._lock_users.get(key, 0) + 1
+        try:
+            await self._debounce(burst)
+            # while the previous reply is pending, the burst keeps collecting messages
+            async with lock:
+                self._close(burst)
+                yield '\n'.join(burst.texts)
+        except Exception as e:
+            burst.error = e
+            raise
+        finally:
+            self._close(burst)
+            burst.done.set()
+            self._lock_users[key] -= 1
+            if not self._lock_users[key]:
+                del self._lock_users[key]
+                del self._locks[key]
@@ -0,0 +1,81 @@
+"""De-duplication of updates redelivered by Telegram after a crash or restart."""
+
+from typing import Any, Awaitable, Callable
+from dotenv import load_dotenv
+
+import logging
+import os
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from redis_pool import get_redis
+
+load_dotenv()
+
+# Seen ids are remembered this many seconds after the last update in their block
+DEDUP_TTL = int(os.getenv('DEDUP_TTL', 60 * 60 * 24))
+# Ids per bitmap key: 8 KB per block of update ids, 512 bytes per block of message ids in a chat
+UPDATE_BLOCK = 1 << 16
+MESSAGE_BLOCK = 1 << 12
+# An update is claimed while it is handled, so a redelivery does not run next to it; must outlast the slowest handler, seconds
+DEDUP_CLAIM_TTL = int(os.getenv('DEDUP_CLAIM_TTL', 300))
+
+
+class UpdateDeduplicationMiddleware(BaseMiddleware):
+    """
+    Outer middleware that drops updates which were already handled, before any handler runs.
+    Handled update ids and chat/message ids are kept as bits in Redis bitmaps with a sliding expiry.
+    An update being handled is claimed in Redis, its redeliveries are dropped until it is handled or the claim expires.
+    """
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]], event: Update, data: dict[str, Any]) -> Any:
+        bits = [(f'dedup:update:{event.update_id // UPDATE_BLOCK}', event.update_id % UPDATE_BLOCK)]
+        if event.message is not None:
+            chat_id, message_id = event.message.chat.id, event.message.message_id
+            bits.append((f'dedup:message:{chat_id}:{message_id // MESSAGE_BLOCK}', message_id % MESSAGE_BLOCK))
+
+        claim = f'dedup:claim:{event.update_id}'
+
+        redis = get_redis()
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                for key, offset in bits:
+                    pipe.getbit(key, offset)
+                pipe.set(claim, 1, nx=True, ex=DEDUP_CLAIM_TTL)
+                *seen, claimed = await pipe.execute()
+        except Exception as e:
+            # without Redis a duplicate is better than a lost update
+            logging.warning(f"Could not check update {event.update_id} for duplicates: {e}")
+            return await handler(event, data)
+
+        if any(seen):
+            logging.info(f"Dropping duplicate update {event.update_id}")
+            return None
+        if not claimed:
+            logging.info(f"Dropping update {event.update_id}, it is being handled")
+            return None
+
+        try:
+            result = await handler(event, data)
+        except BaseException:
+            # an update that failed is handled again when it is redelivered
+            await self._release(claim, event.update_id)
+            raise
+        # marked only once handled, an update cut off by a crash is handled again once its claim expires
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                for key, offset in bits:
+                    pipe.setbit(key, offset, 1)
+                    pipe.expire(key, DEDUP_TTL)
+                pipe.delete(claim)
+                await pipe.execute()
+        except Exception as e:
+            logging.warning(f"Could not mark update {event.update_id} as seen: {e}")
+        return result
+
+    async def _release(self, claim: str, update_id: int) -> None:
+        try:
+            await get_redis().delete(claim)
+        except Exception as e:
+            logging.warning(f"Could not release the claim of update {update_id}: {e}")
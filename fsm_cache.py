@@ -0,0 +1,137 @@
+"""FSM storage with an in-process LRU in front of Redis, invalidated across instances over Redis pub/sub."""
+
+from typing import Any, Optional
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+import asyncio
+import copy
+import logging
+import os
+import uuid
+
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.fsm.storage.redis import RedisStorage
+
+load_dotenv()
+
+# Users whose state and data are kept in memory
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 10000))
+FSM_INVALIDATION_CHANNEL = 'fsm:invalidate'
+# Must stay below the Redis socket timeout
+FSM_INVALIDATION_POLL = 5.0
+
+# marks a part of the entry that is not cached yet, None is a valid state
+_MISSING = object()
+
+
+class CachedRedisStorage(BaseStorage):
+    """
+    Reads state and data from a bounded LRU, misses and all writes go to the wrapped RedisStorage.
+    Every write is announced on FSM_INVALIDATION_CHANNEL so the other instances drop their copy.
+    The cache is bypassed until the invalidation listener is subscribed, and cleared whenever it reconnects.
+    """
+
+    def __init__(self, storage: RedisStorage, max_size: int = FSM_CACHE_SIZE):
+        self.storage = storage
+        self.max_size = max_size
+        self.instance_id = uuid.uuid4().hex
+        # redis key -> [state, data]
+        self._entries: OrderedDict[str, list] = OrderedDict()
+        # bumped on every invalidation, a read that raced with one is not cached
+        self._generation = 0
+        self._listening = False
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_key(self, key: StorageKey) -> str:
+        return self.storage.key_builder.build(key)
+
+    def _get(self, cache_key: str, part: int):
+        entry = self._entries.get(cache_key)
+        if entry is None or entry[part] is _MISSING:
+            return _MISSING
+        self._entries.move_to_end(cache_key)
+        return entry[part]
+
+    def _put(self, cache_key: str, part: int, value) -> None:
+        entry = self._entries.get(cache_key)
+        if entry is None:
+            entry = self._entries[cache_key] = [_MISSING, _MISSING]
+        entry[part] = value
+        self._entries.move_to_end(cache_key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _invalidate(self, cache_key: str) -> None:
+        self._generation += 1
+        self._entries.pop(cache_key, None)
+
+    async def _read(self, key: StorageKey, part: int, fetch):
+        cache_key = self._cache_key(key)
+        if self._listening:
+            value = self._get(cache_key, part)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+        self.misses += 1
+        generation = self._generation
+        value = await fetch(key)
+        if self._listening and generation == self._generation:
+            self._put(cache_key, part, value)
+        return value
+
+    async def _write(self, key: StorageKey, part: int, value, store) -> None:
+        cache_key = self._cache_key(key)
+        # dropped first, so a failed write doesn't leave a copy that Redis doesn't have
+        self._invalidate(cache_key)
+        generation = self._generation
+        await store(key, value)
+        await self.storage.redis.publish(FSM_INVALIDATION_CHANNEL, f'{self.instance_id}:{cache_key}')
+        # another instance may have written the key meanwhile, then Redis holds its value and not this one
+        if self._listening and generation == self._generation:
+            self._put(cache_key, part, value)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if hasattr(state, 'state') else state
+        await self._write(key, 0, state, self.storage.set_state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self._read(key, 0, self.storage.get_state)
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        await self._write(key, 1, copy.deepcopy(data), self.storage.set_data)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        # handlers update the returned dict in place
+        return copy.deepcopy(await self._read(key, 1, self.storage.get_data))
+
+    async def close(self) -> None:
+        await self.storage.close()
+
+    async def listen(self) -> None:
+        """Drops the entries written by other instances, meant to be run as a background task"""
+
+        while True:
+            pubsub = self.storage.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(FSM_INVALIDATION_CHANNEL)
+                # anything written while nobody was listening may be stale
+                self._entries.clear()
+                self._listening = True
+                while True:
+                    message = await pubsub.get_message(timeout=FSM_INVALIDATION_POLL)
+                    if message is None:
+                        continue
+                    instance_id, _, cache_key = message['data'].decode().partition(':')
+                    if instance_id != self.instance_id:
+                        self._invalidate(cache_key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"FSM cache invalidation listener failed: {e}", exc_info=True)
+                await asyncio.sleep(1)
+            finally:
+                self._listening = False
+                self._entries.clear()
+                await pubsub.aclose()
@@ -0,0 +1,71 @@
+"""Pre-generation of daily check greetings, so the scheduled wave doesn't wait on the LLM at delivery time."""
+
+from typing import Awaitable, Callable, Iterable, Optional
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+
+import asyncio
+import logging
+import os
+
+from redis_pool import get_redis
+
+load_dotenv()
+
+# Greetings are generated for the jobs that are due within this many seconds; at least GREETING_PREGEN_INTERVAL,
+# so every job is seen, and below the delivery interval, so only the next delivery of a user is prepared
+GREETING_PREGEN_LEAD = int(os.getenv('GREETING_PREGEN_LEAD', 60 * 3))
+# How often the pre-generation stage runs, seconds
+GREETING_PREGEN_INTERVAL = int(os.getenv('GREETING_PREGEN_INTERVAL', 60 * 2))
+# Pre-generation runs off-peak only: while users' chat requests take at most this share of the chat slots
+GREETING_PREGEN_MAX_LOAD = float(os.getenv('GREETING_PREGEN_MAX_LOAD', 0.5))
+# Greetings generated at once by the pre-generation stage
+GREETING_PREGEN_CONCURRENCY = int(os.getenv('GREETING_PREGEN_CONCURRENCY', 4))
+# How long a pre-generated greeting stays valid, seconds
+GREETING_CACHE_TTL = int(os.getenv('GREETING_CACHE_TTL', 60 * 60))
+
+DAILY_CHECK_JOB_SUFFIX = '_daily_check'
+
+
+def greeting_key(telegram_id: int) -> str:
+    return f'greeting:{telegram_id}'
+
+async def cache_greeting(telegram_id: int, text: str) -> None:
+    await get_redis().set(greeting_key(telegram_id), text.encode(), ex=GREETING_CACHE_TTL)
+
+async def pop_cached_greeting(telegram_id: int) -> Optional[str]:
+    """Returns the pre-generated greeting and removes it, so it is sent only once"""
+    cached = await get_redis().getdel(greeting_key(telegram_id))
+    return cached.decode() if cached is not None else None
+
+def due_telegram_ids(jobs: Iterable, lead: int = GREETING_PREGEN_LEAD) -> list[int]:
+    """Returns telegram ids of the daily check jobs that will run within the lead time"""
+
+    horizon = datetime.now(timezone.utc) + timedelta(seconds=lead)
+    telegram_ids = []
+    for job in jobs:
+        if not job.id.endswith(DAILY_CHECK_JOB_SUFFIX) or job.next_run_time is None:
+            continue
+        if job.next_run_time <= horizon:
+            telegram_ids.append(job.kwargs['telegram_id'])
+    return telegram_ids
+
+async def pregenerate_greetings(telegram_ids: Iterable[int], generate: Callable[[int], Awaitable[str]], concurrency: int = GREETING_PREGEN_CONCURRENCY) -> None:
+    """Generates and caches greetings for the users that don't have one yet, at bounded concurrency"""
+
+    semaphore = asyncio.Semaphore(concurrency)
+    redis = get_redis()
+
+    async def pregenerate(telegram_id: int) -> None:
+        async with semaphore:
+            if await redis.exists(greeting_key(telegram_id)):
+                return
+            try:
+                text = await generate(telegram_id)
+            except Exception as e:
+                # delivery falls back to live generation
+                logging.warning(f"Could not pre-generate the greeting for {telegram_id}: {e}")
+                return
+            await cache_greeting(telegram_id, text)
+
+    await asyncio.gather(*(pregenerate(telegram_id) for telegram_id in set(telegram_ids)))
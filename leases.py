@@ -0,0 +1,88 @@
+"""Redis leases with fencing tokens, so every scheduled run is done by one of the bot instances sharing the job store."""
+
+from typing import Any, Awaitable, Callable, Optional
+from contextvars import ContextVar
+from dataclasses import dataclass
+from dotenv import load_dotenv
+
+import functools
+import inspect
+import logging
+import os
+
+from redis_pool import get_redis
+
+load_dotenv()
+
+# Share of the job interval the lease is held for; instances that fire the same run a bit later find it taken
+LEASE_SLOT_FRACTION = float(os.getenv('LEASE_SLOT_FRACTION', 0.8))
+# One counter for the tokens of all leases, so no key is left behind per user and job
+LEASE_FENCE_KEY = 'lease:fence'
+
+
+class LeaseLost(Exception):
+    """Raised when the lease of a run expired and another instance may have taken the run over"""
+
+
+@dataclass(slots=True)
+class Lease:
+    key: str
+    token: int
+
+    async def check(self) -> None:
+        """
+        Raises LeaseLost unless this lease is still the current holder, called right before side effects.
+        The fence is advisory: the check and the side effect are not atomic and the API service doesn't see the token,
+        so it narrows the window for a stale holder to act instead of closing it.
+        """
+        holder = await get_redis().get(self.key)
+        if holder is None or int(holder) != self.token:
+            raise LeaseLost(f'Lease {self.key} with token {self.token} is no longer held')
+
+
+current_lease: ContextVar[Optional[Lease]] = ContextVar('current_lease', default=None)
+
+
+async def acquire(name: str, ttl: float) -> Optional[Lease]:
+    """Takes the lease for ttl seconds, returns None if another instance holds it"""
+
+    redis = get_redis()
+    # fencing tokens only grow, so a stale holder can never pass for the current one
+    token = await redis.incr(LEASE_FENCE_KEY)
+    if not await redis.set(f'lease:{name}', token, nx=True, px=int(ttl * 1000)):
+        return None
+    return Lease(f'lease:{name}', token)
+
+async def check_lease() -> None:
+    """Checks the lease of the current run, does nothing outside leased jobs"""
+    lease = current_lease.get()
+    if lease is not None:
+        await lease.check()
+
+
+def leased(interval: float, key_arg: str = 'telegram_id'):
+    """
+    Decorator for interval jobs: a run is skipped unless this instance takes the lease for the job and key_arg.
+    The lease is not released when the run ends, it expires after a slot of the interval.
+    """
+
+    def decorator(func: Callable[..., Awaitable[Any]]):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = signature.bind_partial(*args, **kwargs).arguments.get(key_arg)
+            name = func.__name__ if key is None else f'{func.__name__}:{key}'
+            lease = await acquire(name, interval * LEASE_SLOT_FRACTION)
+            if lease is None:
+                logging.debug(f"Skipping {name}, another instance runs it")
+                return
+            token = current_lease.set(lease)
+            try:
+                return await func(*args, **kwargs)
+            except LeaseLost as e:
+                logging.warning(f"Stopping {name}: {e}")
+            finally:
+                current_lease.reset(token)
+        return wrapper
+    return decorator
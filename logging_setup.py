@@ -0,0 +1,135 @@
+"""Non-blocking logging: records go through a queue to a background listener, repeated errors are sampled."""
+
+from typing import Any, Awaitable, Callable, Optional
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from dotenv import load_dotenv
+
+import atexit
+import copy
+import logging
+import os
+import queue
+import sys
+import time
+import zlib
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+load_dotenv()
+
+# Records of the same error signature passed per window, the rest are counted and dropped
+LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', 5))
+LOG_SAMPLE_WINDOW = float(os.getenv('LOG_SAMPLE_WINDOW', 60.0))
+# Users are logged as buckets instead of ids
+LOG_USER_BUCKETS = 1024
+
+STRUCTURED_FIELDS = ('handler', 'user_bucket', 'endpoint', 'latency')
+
+current_handler: ContextVar[Optional[str]] = ContextVar('current_handler', default=None)
+current_user_bucket: ContextVar[Optional[int]] = ContextVar('current_user_bucket', default=None)
+
+
+def user_bucket(user_id: int) -> int:
+    return zlib.crc32(str(user_id).encode()) % LOG_USER_BUCKETS
+
+
+class ContextFilter(logging.Filter):
+    """Adds handler and user bucket of the current update to the record"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, 'handler', None) is None:
+            record.handler = current_handler.get()
+        if getattr(record, 'user_bucket', None) is None:
+            record.user_bucket = current_user_bucket.get()
+        return True
+
+
+class ErrorSampler(logging.Filter):
+    """Passes the first LOG_SAMPLE_BURST warnings and errors of a signature per window and drops the rest"""
+
+    def __init__(self, burst: int = LOG_SAMPLE_BURST, window: float = LOG_SAMPLE_WINDOW):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        # signature -> [window start, passed, suppressed]
+        self.counters: dict[tuple, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+
+        exc_type = record.exc_info[0].__name__ if record.exc_info and record.exc_info[0] else None
+        signature = (record.pathname, record.lineno, exc_type)
+        now = time.monotonic()
+        counter = self.counters.get(signature)
+        if counter is None or now - counter[0] > self.window:
+            suppressed = counter[2] if counter is not None else 0
+            counter = self.counters[signature] = [now, 0, 0]
+            if suppressed:
+                record.suppressed = suppressed
+
+        if counter[1] >= self.burst:
+            counter[2] += 1
+            return False
+        counter[1] += 1
+        return True
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Unlike QueueHandler, leaves the traceback formatting to the listener thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class StructuredFormatter(logging.Formatter):
+    """Appends the structured fields present on the record as key=value pairs"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = [f'{name}={getattr(record, name)}' for name in STRUCTURED_FIELDS + ('suppressed',) if getattr(record, name, None) is not None]
+        if not fields:
+            return line
+        first_line, newline, rest = line.partition('\n')
+        return f"{first_line} | {' '.join(fields)}{newline}{rest}"
+
+
+class LoggingContextMiddleware(BaseMiddleware):
+    """Sets the handler name and user bucket for the records logged while an update is handled"""
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]], event: TelegramObject, data: dict[str, Any]) -> Any:
+        handler_object = data.get('handler')
+        user = data.get('event_from_user')
+        handler_token = current_handler.set(handler_object.callback.__name__ if handler_object is not None else None)
+        bucket_token = current_user_bucket.set(user_bucket(user.id) if user is not None else None)
+        try:
+            return await handler(event, data)
+        finally:
+            current_handler.reset(handler_token)
+            current_user_bucket.reset(bucket_token)
+
+
+def setup_logging(level: int = logging.INFO) -> QueueListener:
+    """Routes all logging through a queue to a stdout handler running in a background thread"""
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(ErrorSampler())
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(StructuredFormatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,209 @@
+"""
+Cache of the per-user lookups against the API service, snapshotted to Redis so that restarts start warm.
+Changes made through one instance are announced over Redis pub/sub, so the other instances drop their copy.
+"""
+
+from typing import Any, Awaitable, Callable, Optional
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+import asyncio
+import logging
+import os
+import time
+
+import orjson
+
+from redis_pool import get_redis
+
+load_dotenv()
+
+# Lookups older than this are fetched again; other instances may have changed them, seconds
+LOOKUP_CACHE_TTL = float(os.getenv('LOOKUP_CACHE_TTL', 300))
+# Users kept in the cache
+LOOKUP_CACHE_SIZE = int(os.getenv('LOOKUP_CACHE_SIZE', 50000))
+# Hash of user email -> lookups, shared by all the instances
+WARM_START_KEY = 'warmstart:lookups'
+# How often the snapshot is written, besides on shutdown, seconds
+WARM_START_INTERVAL = float(os.getenv('WARM_START_INTERVAL', 60))
+# Users revalidated at once after a warm start
+WARM_START_CONCURRENCY = int(os.getenv('WARM_START_CONCURRENCY', 8))
+LOOKUP_INVALIDATION_CHANNEL = 'lookups:invalidate'
+# Must stay below the Redis socket timeout
+LOOKUP_INVALIDATION_POLL = 5.0
+
+# user email -> {'profile': (value, fetched), 'user': (value, fetched)}
+_entries: OrderedDict[str, dict[str, tuple[Any, float]]] = OrderedDict()
+# bumped on every invalidation, a lookup fetched while one arrived is not cached
+_generation = 0
+# the cache is bypassed while the invalidation listener is not subscribed
+_listening = False
+
+
+def _fresh(fetched: float, now: float) -> bool:
+    return now - fetched <= LOOKUP_CACHE_TTL
+
+def get(user_email: str, field: str) -> Optional[Any]:
+    """Returns the cached lookup, None if it is missing or expired"""
+
+    entry = _entries.get(user_email)
+    if not _listening or entry is None or field not in entry:
+        return None
+    value, fetched = entry[field]
+    if not _fresh(fetched, time.time()):
+        del entry[field]
+        return None
+    _entries.move_to_end(user_email)
+    return value
+
+def generation() -> int:
+    """Taken before a lookup is fetched and passed to put, which skips the lookup if an invalidation came in between"""
+    return _generation
+
+def put(user_email: str, fetched: Optional[float] = None, since: Optional[int] = None, **fields) -> None:
+    """Caches the lookups of the user, fetched is the time they were fetched at if it is not now"""
+
+    if since is not None and since != _generation:
+        return
+    fetched = time.time() if fetched is None else fetched
+    entry = _entries.setdefault(user_email, {})
+    for field, value in fields.items():
+        entry[field] = (value, fetched)
+    _entries.move_to_end(user_email)
+    while len(_entries) > LOOKUP_CACHE_SIZE:
+        _entries.popitem(last=False)
+
+def invalidate(user_email: str, *fields: str) -> None:
+    """Drops the given lookups of the user, or all of them"""
+
+    global _generation
+    _generation += 1
+    if not fields:
+        _entries.pop(user_email, None)
+        return
+    entry = _entries.get(user_email)
+    for field in fields:
+        if entry is not None:
+            entry.pop(field, None)
+
+
+async def publish_invalidation(user_email: str) -> None:
+    """Drops the lookups of the user here and on the other instances, called after they were changed through the API"""
+
+    invalidate(user_email)
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            # the snapshot must not bring the old lookups back either
+            pipe.hdel(WARM_START_KEY, user_email)
+            pipe.publish(LOOKUP_INVALIDATION_CHANNEL, user_email)
+            await pipe.execute()
+    except Exception as e:
+        logging.warning(f"Could not announce the change of {user_email}: {e}")
+
+async def listen() -> None:
+    """Drops the lookups changed through other instances, meant to be run as a background task"""
+
+    global _listening
+    subscribed_before = False
+    while True:
+        pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(LOOKUP_INVALIDATION_CHANNEL)
+            # anything changed while nobody was listening may be stale, the warm start lookups are revalidated instead
+            if subscribed_before:
+                _entries.clear()
+            subscribed_before = True
+            _listening = True
+            while True:
+                message = await pubsub.get_message(timeout=LOOKUP_INVALIDATION_POLL)
+                if message is not None:
+                    invalidate(message['data'].decode())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Lookup cache invalidation listener failed: {e}", exc_info=True)
+            await asyncio.sleep(1)
+        finally:
+            _listening = False
+            await pubsub.aclose()
+
+
+async def save_snapshot() -> None:
+    """
+    Writes the fresh lookups to Redis, one hash field per user with the time every lookup was fetched at.
+    Every instance adds its own users, the hash expires when no instance has saved it for LOOKUP_CACHE_TTL.
+    """
+
+    now = time.time()
+    snapshot = {}
+    for user_email, entry in _entries.items():
+        fresh = {field: [value, fetched] for field, (value, fetched) in entry.items() if _fresh(fetched, now)}
+        if fresh:
+            snapshot[user_email] = orjson.dumps(fresh)
+    if not snapshot:
+        return
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.hset(WARM_START_KEY, mapping=snapshot)
+            pipe.pexpire(WARM_START_KEY, int(LOOKUP_CACHE_TTL * 1000))
+            await pipe.execute()
+    except Exception as e:
+        logging.warning(f"Could not save the warm start snapshot: {e}")
+        return
+    logging.info(f"Saved the lookups of {len(snapshot)} users for a warm start")
+
+async def load_snapshot() -> list[str]:
+    """
+    Fills the cache from the snapshot, returns the emails of the loaded users.
+    The lookups keep the age they had when they were saved, expired ones are dropped from the snapshot.
+    """
+
+    redis = get_redis()
+    try:
+        snapshot = await redis.hgetall(WARM_START_KEY)
+    except Exception as e:
+        logging.warning(f"Could not load the warm start snapshot: {e}")
+        return []
+
+    now = time.time()
+    loaded = []
+    expired = []
+    for raw_email, raw_fields in snapshot.items():
+        user_email = raw_email.decode()
+        fields = {field: (value, fetched) for field, (value, fetched) in orjson.loads(raw_fields).items() if _fresh(fetched, now)}
+        if not fields:
+            expired.append(raw_email)
+            continue
+        for field, (value, fetched) in fields.items():
+            put(user_email, fetched=fetched, **{field: value})
+        loaded.append(user_email)
+
+    if expired:
+        try:
+            await redis.hdel(WARM_START_KEY, *expired)
+        except Exception as e:
+            logging.warning(f"Could not drop the expired users from the warm start snapshot: {e}")
+    logging.info(f"Loaded the lookups of {len(loaded)} users for a warm start")
+    return loaded
+
+async def revalidate(user_emails: list[str], refresh: Callable[[str], Awaitable[None]]) -> None:
+    """Refreshes the loaded users in the background, meant to be run as a task"""
+
+    semaphore = asyncio.Semaphore(WARM_START_CONCURRENCY)
+
+    async def revalidate_user(user_email: str) -> None:
+        async with semaphore:
+            try:
+                await refresh(user_email)
+            except Exception as e:
+                invalidate(user_email)
+                logging.warning(f"Could not revalidate {user_email}: {e}")
+
+    await asyncio.gather(*(revalidate_user(user_email) for user_email in user_emails))
+    logging.info(f"Revalidated the lookups of {len(user_emails)} users")
+
+async def snapshot_periodically(interval: float = WARM_START_INTERVAL) -> None:
+    """Saves the snapshot periodically, meant to be run as a background task"""
+    while True:
+        await asyncio.sleep(interval)
+        await save_snapshot()
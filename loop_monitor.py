@@ -0,0 +1,94 @@
+"""Event loop lag monitor: measures scheduling delay continuously and catches the code that blocks the loop."""
+
+from typing import Optional
+from collections import deque
+from dotenv import load_dotenv
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+load_dotenv()
+
+# How often the loop is probed, seconds
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.1))
+# A stall longer than this is reported with the stack of the code that blocks the loop, seconds
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', 0.25))
+# How often lag percentiles are logged, seconds
+LOOP_LAG_REPORT_INTERVAL = float(os.getenv('LOOP_LAG_REPORT_INTERVAL', 60.0))
+# Lag samples kept for the percentiles
+LOOP_LAG_WINDOW = 2048
+
+
+class LoopMonitor:
+    """
+    A task on the loop sleeps for LOOP_LAG_INTERVAL and records how late it wakes up.
+    A watchdog thread checks the heartbeat of that task, when it is late by more than LOOP_LAG_THRESHOLD
+    the loop is blocked right now, so the stack of the loop thread shows the blocking call.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_LAG_THRESHOLD, report_interval: float = LOOP_LAG_REPORT_INTERVAL):
+        self.interval = interval
+        self.threshold = threshold
+        self.report_interval = report_interval
+        self.samples: deque[float] = deque(maxlen=LOOP_LAG_WINDOW)
+        self.stalls = 0
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+
+    def stats(self) -> dict:
+        ordered = sorted(self.samples)
+
+        def percentile(q: float) -> float:
+            if not ordered:
+                return 0.0
+            return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+        return {
+            'lag_p50': percentile(0.5),
+            'lag_p90': percentile(0.9),
+            'lag_p99': percentile(0.99),
+            'lag_max': round(ordered[-1], 4) if ordered else 0.0,
+            'stalls': self.stalls,
+        }
+
+    async def probe(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.samples.append(max(0.0, now - expected))
+            self._heartbeat = now
+
+    async def report_stats(self) -> None:
+        while True:
+            await asyncio.sleep(self.report_interval)
+            logging.info(f"Event loop lag: {self.stats()}")
+
+    def watchdog(self) -> None:
+        """Runs in a daemon thread, captures the stack of the loop thread once per stall"""
+
+        reported = None
+        while True:
+            time.sleep(self.interval)
+            heartbeat = self._heartbeat
+            lag = time.monotonic() - heartbeat - self.interval
+            if lag < self.threshold or reported == heartbeat:
+                continue
+            reported = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else 'unavailable\n'
+            logging.warning(f"Event loop is blocked for {lag:.3f}s, loop thread stack:\n{stack}")
+
+    async def run(self) -> None:
+        """Monitors the running loop, meant to be run as a background task"""
+
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        threading.Thread(target=self.watchdog, name='loop-watchdog', daemon=True).start()
+        await asyncio.gather(self.probe(), self.report_stats())
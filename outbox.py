@@ -0,0 +1,55 @@
+"""Durable write-behind outbox for bookkeeping writes to the API service, backed by a Redis stream."""
+
+from typing import Any, Awaitable, Callable
+from dotenv import load_dotenv
+
+import asyncio
+import json
+import os
+
+from redis_pool import get_redis
+from redis_streams import StreamConsumer, STREAM_MAXLEN
+from to_api_utils import get_async_client
+from backend import create_assistant_message, save_message_feedback
+from priority import batch_job
+
+load_dotenv()
+
+OUTBOX_STREAM = 'outbox:writes'
+OUTBOX_DEAD_STREAM = 'outbox:dead'
+OUTBOX_GROUP = 'outbox-writers'
+# Writes taken and sent at once by the consumer
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 20))
+# Attempts before a write is moved to the dead letter stream
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+# Failed writes, and writes taken by a consumer that died, are picked up again after this many milliseconds
+OUTBOX_RETRY_IDLE_MS = int(os.getenv('OUTBOX_RETRY_IDLE_MS', 30 * 1000))
+
+WRITERS: dict[str, Callable[..., Awaitable[None]]] = {
+    'assistant_message': create_assistant_message,
+    'feedback': save_message_feedback,
+}
+
+
+async def enqueue(kind: str, **payload) -> None:
+    """Puts a write into the outbox, it is sent to the API in the background"""
+
+    if kind not in WRITERS:
+        raise ValueError(f'Unknown outbox write: {kind}')
+    fields = {'kind': kind, 'payload': json.dumps(payload)}
+    await get_redis().xadd(OUTBOX_STREAM, fields, maxlen=STREAM_MAXLEN, approximate=True)
+
+
+class OutboxConsumer(StreamConsumer):
+    """Sends the writes from the outbox in batches, sharing one HTTP client per batch"""
+
+    def __init__(self):
+        super().__init__(OUTBOX_STREAM, OUTBOX_GROUP, OUTBOX_DEAD_STREAM, OUTBOX_BATCH_SIZE, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_IDLE_MS)
+
+    async def handle_entry(self, fields: dict, **shared: Any) -> None:
+        await WRITERS[fields[b'kind'].decode()](**json.loads(fields[b'payload']), client=shared['client'])
+
+    @batch_job
+    async def handle_batch(self, entries: list) -> None:
+        async with get_async_client() as client:
+            await asyncio.gather(*(self.process_entry(entry_id, fields, client=client) for entry_id, fields in entries))
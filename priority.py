@@ -0,0 +1,168 @@
+"""Priority lanes: interactive replies get reserved capacity of the shared resources, scheduled fan-out only takes what is left."""
+
+from typing import Any, AsyncIterator, Awaitable, Callable
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+import asyncio
+import functools
+import logging
+
+import httpx
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods.base import TelegramMethod, TelegramType, Response
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+# Lane of the code running in this context, updates are interactive unless they run in a batch job
+current_lane: ContextVar[str] = ContextVar('current_lane', default=INTERACTIVE)
+
+
+def batch_job(func: Callable[..., Awaitable[Any]]):
+    """Decorator that runs a scheduled job or a background consumer in the batch lane"""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = current_lane.set(BATCH)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            current_lane.reset(token)
+    return wrapper
+
+
+class PriorityLimiter:
+    """
+    Limits concurrent use of a resource to `capacity` slots, `reserved` of them only for the interactive lane.
+    Interactive waiters are served first, and the batch lane doesn't start anything while interactive work is waiting.
+    """
+
+    def __init__(self, name: str, capacity: int, reserved: int):
+        self.name = name
+        self.capacity = capacity
+        self.reserved = min(reserved, capacity - 1)
+        self.in_use = {INTERACTIVE: 0, BATCH: 0}
+        self._waiters: dict[str, deque[asyncio.Future]] = {INTERACTIVE: deque(), BATCH: deque()}
+
+    def _has_room(self, lane: str) -> bool:
+        used = self.in_use[INTERACTIVE] + self.in_use[BATCH]
+        if lane == INTERACTIVE:
+            return used < self.capacity
+        return used < self.capacity - self.reserved and not self._waiters[INTERACTIVE]
+
+    def _wake(self) -> None:
+        for lane in (INTERACTIVE, BATCH):
+            waiters = self._waiters[lane]
+            while waiters and self._has_room(lane):
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    self.in_use[lane] += 1
+                    waiter.set_result(None)
+
+    async def acquire(self, lane: str) -> None:
+        if not self._waiters[lane] and self._has_room(lane):
+            self.in_use[lane] += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just before the cancellation
+                self.release(lane)
+            else:
+                if waiter in self._waiters[lane]:
+                    self._waiters[lane].remove(waiter)
+                # a batch waiter may be unblocked by an interactive one giving up
+                self._wake()
+            raise
+
+    def release(self, lane: str) -> None:
+        self.in_use[lane] -= 1
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Holds a slot in the lane of the current context"""
+        lane = current_lane.get()
+        await self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    def stats(self) -> dict:
+        return {
+            'interactive_running': self.in_use[INTERACTIVE],
+            'batch_running': self.in_use[BATCH],
+            'interactive_waiting': len(self._waiters[INTERACTIVE]),
+            'batch_waiting': len(self._waiters[BATCH]),
+        }
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self.stream = stream
+        self.release = release
+        self.released = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.released:
+                self.released = True
+                self.release()
+
+
+class PriorityTransport(httpx.AsyncBaseTransport):
+    """httpx transport that holds a slot of the limiter for every request until its response is closed"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, limiter: PriorityLimiter):
+        self.transport = transport
+        self.limiter = limiter
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        lane = current_lane.get()
+        await self.limiter.acquire(lane)
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self.limiter.release(lane)
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ReleasingStream(response.stream, lambda: self.limiter.release(lane)),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class PriorityRequestMiddleware(BaseRequestMiddleware):
+    """Bot session middleware that holds a slot of the limiter for every call of the Telegram Bot API"""
+
+    def __init__(self, limiter: PriorityLimiter):
+        self.limiter = limiter
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot: Bot, method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        async with self.limiter.slot():
+            return await make_request(bot, method)
+
+
+async def report_stats(limiters: list[PriorityLimiter], interval: float) -> None:
+    """Logs the lane metrics of the limiters periodically, meant to be run as a background task"""
+    while True:
+        await asyncio.sleep(interval)
+        logging.info(f"Priority lanes: { {limiter.name: limiter.stats() for limiter in limiters} }")
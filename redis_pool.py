@@ -0,0 +1,61 @@
+"""Shared, configurable Redis connections for FSM storage, the job store and caches."""
+
+from typing import Optional
+from dotenv import load_dotenv
+
+import os
+import redis
+import redis.asyncio
+
+load_dotenv()
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
+# Path to the Redis unix socket, takes precedence over REDIS_URL when set
+REDIS_UNIX_SOCKET = os.getenv('REDIS_UNIX_SOCKET')
+REDIS_DB = int(os.getenv('REDIS_DB', 0))
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', 10.0))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv('REDIS_SOCKET_CONNECT_TIMEOUT', 5.0))
+REDIS_SOCKET_KEEPALIVE = os.getenv('REDIS_SOCKET_KEEPALIVE', 'true').lower() in ('1', 'true', 'yes')
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30))
+
+_async_client: Optional[redis.asyncio.Redis] = None
+_sync_client: Optional[redis.Redis] = None
+
+
+def get_redis_url() -> str:
+    if REDIS_UNIX_SOCKET:
+        return f'unix://{REDIS_UNIX_SOCKET}?db={REDIS_DB}'
+    return REDIS_URL
+
+def get_pool_kwargs() -> dict:
+    """Connection pool settings shared by the async and the sync pools"""
+
+    kwargs = {
+        'max_connections': REDIS_MAX_CONNECTIONS,
+        'socket_timeout': REDIS_SOCKET_TIMEOUT,
+        'socket_connect_timeout': REDIS_SOCKET_CONNECT_TIMEOUT,
+        'health_check_interval': REDIS_HEALTH_CHECK_INTERVAL,
+    }
+    # keepalive is a TCP option, unix socket connections don't accept it
+    if not REDIS_UNIX_SOCKET:
+        kwargs['socket_keepalive'] = REDIS_SOCKET_KEEPALIVE
+    return kwargs
+
+def get_redis() -> redis.asyncio.Redis:
+    """Returns the process-wide async Redis client, all users share its connection pool"""
+
+    global _async_client
+    if _async_client is None:
+        pool = redis.asyncio.ConnectionPool.from_url(get_redis_url(), **get_pool_kwargs())
+        _async_client = redis.asyncio.Redis(connection_pool=pool)
+    return _async_client
+
+def get_sync_redis() -> redis.Redis:
+    """Returns the process-wide sync Redis client, for APScheduler's job store which is synchronous"""
+
+    global _sync_client
+    if _sync_client is None:
+        pool = redis.ConnectionPool.from_url(get_redis_url(), **get_pool_kwargs())
+        _sync_client = redis.Redis(connection_pool=pool)
+    return _sync_client
@@ -0,0 +1,96 @@
+"""Consumer group reader for Redis streams with retries and a dead letter stream."""
+
+from abc import ABC, abstractmethod
+from typing import Any
+from dotenv import load_dotenv
+
+import asyncio
+import logging
+import os
+import socket
+
+from redis.exceptions import ResponseError
+
+from redis_pool import get_redis
+
+load_dotenv()
+
+# Approximate max length of the streams
+STREAM_MAXLEN = int(os.getenv('STREAM_MAXLEN', 100000))
+# Must stay below the Redis socket timeout
+STREAM_BLOCK_MS = 5000
+
+
+class StreamConsumer(ABC):
+    """
+    Reads a stream in batches as a member of a consumer group and acknowledges the entries that were handled.
+    Failed entries stay pending and are claimed again after retry_idle_ms, after max_attempts deliveries they go to the dead letter stream.
+    Subclasses implement handle_entry, and handle_batch to share resources across a batch.
+    """
+
+    def __init__(self, stream: str, group: str, dead_stream: str, batch_size: int, max_attempts: int, retry_idle_ms: int, name: str = f'{socket.gethostname()}-{os.getpid()}'):
+        self.stream = stream
+        self.group = group
+        self.dead_stream = dead_stream
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_idle_ms = retry_idle_ms
+        self.name = name
+        self.redis = get_redis()
+
+    async def ensure_group(self) -> None:
+        try:
+            await self.redis.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    @abstractmethod
+    async def handle_entry(self, fields: dict, **shared: Any) -> None:
+        """Handles the fields of one entry, shared holds the resources that handle_batch passed to process_entry"""
+
+    async def handle_batch(self, entries: list) -> None:
+        """Handles the entries one by one, subclasses can share resources across the batch"""
+        for entry_id, fields in entries:
+            await self.process_entry(entry_id, fields)
+
+    async def process_entry(self, entry_id: bytes, fields: dict, **shared: Any) -> None:
+        """Handles one entry and acknowledges it, or leaves it pending for a retry"""
+
+        try:
+            await self.handle_entry(fields, **shared)
+        except Exception as e:
+            pending = await self.redis.xpending_range(self.stream, self.group, min=entry_id, max=entry_id, count=1)
+            attempts = pending[0]['times_delivered'] if pending else self.max_attempts
+            if attempts < self.max_attempts:
+                logging.warning(f"Entry {entry_id} of {self.stream} failed {attempts} times, will retry: {e}")
+                return
+            logging.error(f"Entry {entry_id} of {self.stream} failed {attempts} times, moving it to {self.dead_stream}: {e}")
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.xadd(self.dead_stream, fields, maxlen=STREAM_MAXLEN, approximate=True)
+                pipe.xack(self.stream, self.group, entry_id)
+                await pipe.execute()
+            return
+        await self.redis.xack(self.stream, self.group, entry_id)
+
+    async def run(self) -> None:
+        """Consumes the stream forever, meant to be run as a background task"""
+
+        await self.ensure_group()
+        while True:
+            try:
+                # failed entries and entries of consumers that died before acknowledging them
+                _, claimed, *_ = await self.redis.xautoclaim(self.stream, self.group, self.name, self.retry_idle_ms, count=self.batch_size)
+                # entries deleted from the stream come back without fields
+                claimed = [(entry_id, fields) for entry_id, fields in claimed if fields]
+                if claimed:
+                    await self.handle_batch(claimed)
+
+                response = await self.redis.xreadgroup(self.group, self.name, {self.stream: '>'}, count=self.batch_size, block=STREAM_BLOCK_MS)
+                for _, entries in response:
+                    await self.handle_batch(entries)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Consumer of {self.stream} failed: {e}", exc_info=True)
+                await asyncio.sleep(1)
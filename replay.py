@@ -0,0 +1,229 @@
+"""
+Replays a traffic capture (see capture.py) through the dispatcher against stub Telegram and API endpoints,
+keeping the inter-arrival times scaled by --speed, and reports latency and throughput.
+
+    python replay.py capture.jsonl --speed 10
+
+Redis is real: point REDIS_DB (or REDIS_URL) to a database of its own, the replayed users get FSM states and outbox writes there.
+"""
+
+import os
+
+# the stubs answer for Telegram and the API service, nothing may reach the real bot, Sentry or another capture
+os.environ['TG_BOT_TOKEN'] = '123456789:' + 'A' * 35
+os.environ['SENTRY_DSN'] = ''
+os.environ['TRAFFIC_CAPTURE_PATH'] = ''
+os.environ['TELEGRAM_API_SERVER'] = ''
+os.environ['BACKEND_API_ENDPOINT'] = 'http://api.replay'
+os.environ['BACKEND_API_KEY'] = 'replay'
+
+from collections import Counter
+from datetime import datetime
+from typing import Any, AsyncGenerator, Optional
+
+import argparse
+import asyncio
+import itertools
+import random
+import re
+import time
+
+import httpx
+import orjson
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.methods import GetFile, GetMe, SendMessage, TelegramMethod
+from aiogram.types import Chat, File, Message, Update, User
+
+import bot as bot_module
+import lookup_cache
+import to_api_utils
+import voice
+from loop_monitor import LoopMonitor
+
+# Text of every stubbed LLM answer, long enough to be split like a real one
+STUB_ANSWER = ' '.join(['This is a **stub** answer of the assistant.'] * 40)
+
+
+class StubSession(BaseSession):
+    """Answers the Bot API calls locally after `latency` seconds and counts them"""
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.message_ids = itertools.count(1)
+        # voice file id -> size
+        self.files: dict[str, int] = {}
+
+    async def close(self) -> None:
+        pass
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        self.calls[type(method).__name__] += 1
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if isinstance(method, SendMessage):
+            return Message(message_id=next(self.message_ids), date=datetime.now(), chat=Chat(id=method.chat_id, type='private'), text=method.text)
+        if isinstance(method, GetFile):
+            return File(file_id=method.file_id, file_unique_id=method.file_id, file_size=self.files.get(method.file_id), file_path=f'voice/{method.file_id}.oga')
+        if isinstance(method, GetMe):
+            return User(id=bot.id, is_bot=True, first_name='Replay')
+        return True
+
+    async def stream_content(self, url: str, headers: Optional[dict[str, Any]] = None, timeout: int = 30, chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        file_id = url.rsplit('/', 1)[-1].removesuffix('.oga')
+        yield b'\0' * (self.files.get(file_id) or 0)
+
+
+class StubBackend:
+    """httpx.MockTransport handler that answers the API service endpoints after a lookup, write or chat latency"""
+
+    def __init__(self, lookup_latency: float, chat_latency: float):
+        self.lookup_latency = lookup_latency
+        self.chat_latency = chat_latency
+        self.calls: Counter = Counter()
+        self.routes = [
+            ('GET', re.compile(r'/profiles/email/[^/]+$'), 'lookup', lambda match: {'preferred_lang': 'en'}),
+            ('GET', re.compile(r'/users/email/([^/]+)$'), 'lookup', lambda match: {'id': 1, 'email': match[1]}),
+            ('GET', re.compile(r'/users/\d+/profile$'), 'lookup', lambda match: {'preferred_lang': 'en'}),
+            ('GET', re.compile(r'/users/[^/]+/assistant_messages$'), 'lookup', lambda match: []),
+            ('GET', re.compile(r'/initial_advice_piece_count/[^/]+$'), 'lookup', lambda match: 0),
+            ('GET', re.compile(r'/initial_advice_piece/[^/]+$'), 'lookup', lambda match: {'text': STUB_ANSWER}),
+            ('GET', re.compile(r'/chat/[^/]+/greet$'), 'chat', lambda match: 'Hello! How are you today?'),
+            ('GET', re.compile(r'/chat/[^/]+/(start|complete|daily_advice|message/[^/]+)$'), 'chat', lambda match: {'thread_id': 'replay', 'text': STUB_ANSWER}),
+        ]
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        if request.method in ('POST', 'PATCH'):
+            self.calls['write'] += 1
+            await asyncio.sleep(self.lookup_latency * random.uniform(0.5, 1.5))
+            return httpx.Response(200, content=orjson.dumps({'id': 1}))
+
+        for method, pattern, kind, body in self.routes:
+            match = pattern.search(request.url.path)
+            if method == request.method and match is not None:
+                self.calls[kind] += 1
+                latency = self.chat_latency if kind == 'chat' else self.lookup_latency
+                await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+                return httpx.Response(200, content=orjson.dumps(body(match)))
+        self.calls['not_found'] += 1
+        return httpx.Response(404)
+
+
+class StubTranscription(voice.TranscriptionBackend):
+    """Takes `latency` seconds per second of audio"""
+
+    name = 'stub'
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def transcribe(self, buffer_data: bytes, lang: str) -> str:
+        # the stub session sends zero bytes, about 4 KB per second of Opus
+        await asyncio.sleep(self.latency * len(buffer_data) / 4000)
+        return 'stub transcription of the voice message'
+
+
+def load_records(path: str) -> list[dict]:
+    with open(path, 'rb') as file:
+        return [orjson.loads(line) for line in file if line.strip()]
+
+def build_update(record: dict, update_id: int, message_id: int, session: StubSession, bot: Bot) -> Update:
+    user = {'id': record['user'], 'is_bot': False, 'first_name': 'Replay'}
+    message = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': record['user'], 'type': 'private'}, 'from': user}
+
+    if record['kind'] == 'callback_query':
+        message['text'] = record.get('text')
+        data = {'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': 'replay', 'data': record.get('data'), 'message': message}}
+    else:
+        if record.get('content') == 'voice':
+            file_id = f'replay{update_id}'
+            session.files[file_id] = record.get('size') or 0
+            message['voice'] = {'file_id': file_id, 'file_unique_id': file_id, 'duration': record.get('duration') or 0, 'file_size': record.get('size'), 'mime_type': record.get('mime')}
+        elif record.get('text') is not None:
+            message['text'] = record['text']
+        data = {'message': message}
+    return Update.model_validate({'update_id': update_id, **data}, context={'bot': bot})
+
+async def seed_users(records: list[dict], bot: Bot) -> None:
+    """Puts every user into the state of their first recorded update, with the data the handlers expect"""
+
+    seen = set()
+    for record in records:
+        if record['user'] in seen:
+            continue
+        seen.add(record['user'])
+        key = StorageKey(bot.id, record['user'], record['user'])
+        await bot_module.dp.storage.set_state(key, record.get('state'))
+        await bot_module.dp.storage.set_data(key, {'preferred_lang': 'en', 'thread_id': 'replay', 'greeting': 'Hello!', 'notes': ''})
+
+def percentile(ordered: list[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def replay(path: str, speed: float, telegram_latency: float, lookup_latency: float, chat_latency: float, transcription_latency: float) -> None:
+    records = load_records(path)
+    bot = bot_module.bot
+    session = StubSession(telegram_latency)
+    bot.session = session
+    backend = StubBackend(lookup_latency, chat_latency)
+    to_api_utils.set_transport(httpx.MockTransport(backend))
+    voice.deepgram_backend = StubTranscription(transcription_latency)
+    # the stub audio can't be decoded, and the real pipeline is not what is measured here
+    voice.VAD_ENABLED = False
+    voice.LONG_AUDIO_THRESHOLD = float('inf')
+
+    monitor = LoopMonitor(report_interval=float('inf'))
+    background = [asyncio.create_task(monitor.run()), asyncio.create_task(bot_module.fsm_storage.listen()), asyncio.create_task(lookup_cache.listen())]
+    await seed_users(records, bot)
+
+    loop = asyncio.get_running_loop()
+    # update ids of every run are new, or the de-duplication would drop them
+    first_id = random.randrange(1 << 30)
+
+    async def feed(update: Update, scheduled: float) -> tuple[float, bool]:
+        try:
+            await bot_module.dp.feed_update(bot, update)
+            ok = True
+        except Exception:
+            ok = False
+        return loop.time() - scheduled, ok
+
+    tasks = []
+    start = loop.time()
+    offset = 0.0
+    for number, record in enumerate(records):
+        offset += record.get('dt', 0.0) / speed
+        delay = start + offset - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update = build_update(record, first_id + number, number + 1, session, bot)
+        tasks.append(asyncio.create_task(feed(update, start + offset)))
+    results = await asyncio.gather(*tasks)
+    wall_time = loop.time() - start
+
+    for task in background:
+        task.cancel()
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, ok in results if not ok)
+    print(f"Updates: {len(results)}, errors: {errors}, speed: {speed}x, wall time: {wall_time:.2f}s")
+    print(f"Throughput: {len(results) / wall_time if wall_time else 0.0:.2f} updates/s")
+    print(f"Latency: p50={percentile(latencies, 0.5):.3f}s p90={percentile(latencies, 0.9):.3f}s p99={percentile(latencies, 0.99):.3f}s max={latencies[-1] if latencies else 0.0:.3f}s")
+    print(f"Event loop: {monitor.stats()}")
+    print(f"Telegram calls: {dict(session.calls)}")
+    print(f"API calls: {dict(backend.calls)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay captured traffic against stub Telegram and API endpoints')
+    parser.add_argument('path', help='JSON lines file written by the traffic capture')
+    parser.add_argument('--speed', type=float, default=1.0, help='time scale of the inter-arrival times, e.g. 1, 10 or 100')
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='seconds per Bot API call')
+    parser.add_argument('--lookup-latency', type=float, default=0.03, help='seconds per API lookup or write')
+    parser.add_argument('--chat-latency', type=float, default=3.0, help='seconds per LLM-backed API call')
+    parser.add_argument('--transcription-latency', type=float, default=0.3, help='seconds per second of voice')
+    args = parser.parse_args()
+    asyncio.run(replay(args.path, args.speed, args.telegram_latency, args.lookup_latency, args.chat_latency, args.transcription_latency))
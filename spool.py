@@ -0,0 +1,115 @@
+"""Spool directory for audio working files with a size cap and guaranteed cleanup."""
+
+from typing import AsyncIterator
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+
+import asyncio
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from voice import clean_audio_file
+
+load_dotenv()
+
+# Point it to a tmpfs mount (e.g. /dev/shm/tgfront-audio) to keep audio off the disk
+AUDIO_SPOOL_DIR = os.getenv('AUDIO_SPOOL_DIR', 'files')
+# Cap of every instance, instances that share the directory each get a subdirectory of their own
+AUDIO_SPOOL_MAX_BYTES = int(os.getenv('AUDIO_SPOOL_MAX_BYTES', 200 * 1024 * 1024))
+# Subdirectories of other instances that have not changed for this long are left over by crashed runs, seconds
+AUDIO_SPOOL_STALE_AGE = float(os.getenv('AUDIO_SPOOL_STALE_AGE', 60 * 60))
+AUDIO_FILE_PREFIX = 'audio'
+INSTANCE_DIR_PREFIX = 'spool-'
+
+
+class AudioSpool:
+    """Hands out audio working files, removes them after use and keeps the total size under the cap"""
+
+    def __init__(self, directory: str = AUDIO_SPOOL_DIR, max_bytes: int = AUDIO_SPOOL_MAX_BYTES):
+        self.root = directory
+        self.directory = os.path.join(directory, f'{INSTANCE_DIR_PREFIX}{uuid.uuid4().hex}')
+        self.max_bytes = max_bytes
+        self.active: set[str] = set()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _spooled_files(self, directory: str) -> list[tuple[str, os.stat_result]]:
+        files = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.startswith(AUDIO_FILE_PREFIX) or not entry.is_file():
+                    continue
+                # files can be removed by their handlers while we scan
+                try:
+                    files.append((entry.path, entry.stat()))
+                except FileNotFoundError:
+                    continue
+        return files
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _is_stale(self, directory: str, stale_before: float) -> bool:
+        """Nothing in the directory has changed since stale_before, so no running instance uses it"""
+        try:
+            return os.stat(directory).st_mtime < stale_before and all(stat.st_mtime < stale_before for _, stat in self._spooled_files(directory))
+        except FileNotFoundError:
+            return False
+
+    def sweep(self) -> int:
+        """
+        Removes the files left over by previous runs, meant to be called at startup.
+        Other instances may share the directory, so only their subdirectories that went stale are removed.
+        """
+
+        stale_before = time.time() - AUDIO_SPOOL_STALE_AGE
+        removed = 0
+        with os.scandir(self.root) as entries:
+            others = [entry.path for entry in entries if entry.name.startswith(INSTANCE_DIR_PREFIX) and entry.is_dir() and entry.path != self.directory]
+        for directory in others:
+            if self._is_stale(directory, stale_before):
+                removed += len(self._spooled_files(directory))
+                shutil.rmtree(directory, ignore_errors=True)
+        # files spooled before the instances got subdirectories
+        for path, stat in self._spooled_files(self.root):
+            if stat.st_mtime < stale_before:
+                self._remove(path)
+                removed += 1
+        if removed:
+            logging.info(f"Removed {removed} orphaned audio files from {self.root}")
+        return removed
+
+    def _make_room(self, size: int) -> None:
+        # the directory is recreated if a sweep took it for stale while the instance was idle
+        os.makedirs(self.directory, exist_ok=True)
+        files = self._spooled_files(self.directory)
+        total = sum(stat.st_size for _, stat in files)
+        # files in use are left to their handlers, only stale ones are evicted
+        for path, stat in sorted(files, key=lambda item: item[1].st_mtime):
+            if total + size <= self.max_bytes:
+                return
+            if path in self.active:
+                continue
+            self._remove(path)
+            total -= stat.st_size
+        if total + size > self.max_bytes:
+            logging.warning(f"Audio spool is over the cap: {total + size} of {self.max_bytes} bytes are in use")
+
+    @asynccontextmanager
+    async def file(self, name: str, size: int = 0) -> AsyncIterator[str]:
+        """Yields a path in the spool for a file of the expected size and removes the file on exit, even on errors"""
+
+        path = os.path.join(self.directory, f'{AUDIO_FILE_PREFIX}{name}')
+        await asyncio.to_thread(self._make_room, size)
+        self.active.add(path)
+        try:
+            yield path
+        finally:
+            self.active.discard(path)
+            if os.path.exists(path):
+                await clean_audio_file(path)
@@ -0,0 +1,33 @@
+"""Bot API server settings: the public API, or a self-hosted server in local mode whose files are read straight from disk."""
+
+from typing import Optional
+from pathlib import Path
+from dotenv import load_dotenv
+
+import os
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer, BareFilesPathWrapper, SimpleFilesPathWrapper
+
+load_dotenv()
+
+# Base URL of a self-hosted Bot API server running with --local, e.g. http://localhost:8081
+TELEGRAM_API_SERVER = os.getenv('TELEGRAM_API_SERVER')
+# Working directory of the server (--dir) and where the bot sees it, if it is mounted at another path; the bot removes the voice files from it, so it must be writable
+TELEGRAM_API_SERVER_DIR = os.getenv('TELEGRAM_API_SERVER_DIR')
+TELEGRAM_API_LOCAL_DIR = os.getenv('TELEGRAM_API_LOCAL_DIR')
+
+
+def local_mode() -> bool:
+    return bool(TELEGRAM_API_SERVER)
+
+def create_session() -> Optional[AiohttpSession]:
+    """Session for the self-hosted server, None to use the public Bot API"""
+
+    if not local_mode():
+        return None
+    if TELEGRAM_API_SERVER_DIR and TELEGRAM_API_LOCAL_DIR:
+        wrap_local_file = SimpleFilesPathWrapper(Path(TELEGRAM_API_SERVER_DIR), Path(TELEGRAM_API_LOCAL_DIR))
+    else:
+        wrap_local_file = BareFilesPathWrapper()
+    return AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER, is_local=True, wrap_local_file=wrap_local_file))
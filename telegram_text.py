@@ -0,0 +1,276 @@
+"""Preparation of assistant texts for Telegram: splitting into messages and rendering markdown to HTML."""
+
+from typing import Any, Optional
+from functools import lru_cache
+
+import re
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Markdown markers and the HTML tags they are rendered to
+HTML_TAGS = {
+    '**': 'b',
+    '__': 'b',
+    '*': 'b',
+    '_': 'i',
+    '~~': 's',
+}
+# Longer markers go first so that ** is not read as two *
+INLINE_MARKERS = ('**', '__', '~~', '*', '_')
+
+LINK = re.compile(r'\[([^\]\n]+)\]\(([^)\s]+)\)')
+HEADING = re.compile(r'^#{1,6}\s+(.+?)\s*#*$')
+BULLET = re.compile(r'^(\s*)[*\-+]\s+')
+
+# Separators the text is split at, from the most to the least preferred
+PARAGRAPH_END = re.compile(r'\n\s*\n')
+LINE_END = re.compile(r'\n')
+SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+WORD_END = re.compile(r'\s+')
+SEPARATORS = (PARAGRAPH_END, LINE_END, SENTENCE_END, WORD_END)
+
+# A piece of the rendered text: (kind, position in the markdown, html, closing tag), kind is text, open or close
+Piece = tuple[str, int, str, Optional[str]]
+
+
+def escape_html(text: str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def _is_flanked(text: str, start: int, end: int) -> bool:
+    """Underscores inside words (snake_case) are not markdown"""
+    return start > 0 and text[start - 1].isalnum() and end < len(text) and text[end].isalnum()
+
+def _tokenize_inline(text: str) -> list[tuple[str, Any, int, int]]:
+    """
+    Splits one line into (kind, value, start, end) tokens, kind is text, code, link, open or close.
+    Unbalanced markers are kept as text.
+    """
+
+    tokens: list[tuple[str, Any, int, int]] = []
+    # open markers with the index of their token
+    stack: list[tuple[str, int]] = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+
+        if char == '\\' and i + 1 < len(text) and not text[i + 1].isalnum():
+            tokens.append(('text', text[i + 1], i, i + 2))
+            i += 2
+            continue
+
+        if char == '`':
+            end = text.find('`', i + 1)
+            if end != -1:
+                tokens.append(('code', text[i + 1:end], i, end + 1))
+                i = end + 1
+                continue
+
+        if char == '[':
+            link = LINK.match(text, i)
+            if link:
+                tokens.append(('link', (link.group(1), link.group(2)), i, link.end()))
+                i = link.end()
+                continue
+
+        marker = next((marker for marker in INLINE_MARKERS if text.startswith(marker, i)), None)
+        if marker is not None and not (marker[0] == '_' and _is_flanked(text, i, i + len(marker))):
+            opened = [open_marker for open_marker, _ in stack]
+            if marker in opened:
+                # markers opened after this one were never closed, they stay plain text
+                while stack[-1][0] != marker:
+                    stack.pop()
+                _, position = stack.pop()
+                tokens[position] = ('open', marker, *tokens[position][2:])
+                tokens.append(('close', marker, i, i + len(marker)))
+            else:
+                stack.append((marker, len(tokens)))
+                tokens.append(('text', marker, i, i + len(marker)))
+            i += len(marker)
+            continue
+
+        tokens.append(('text', char, i, i + 1))
+        i += 1
+
+    return tokens
+
+def _render_inline(text: str, offset: int, pieces: list[Piece]) -> None:
+    """Renders inline markdown of one line, offset is the position of the line in the text"""
+
+    for kind, value, start, end in _tokenize_inline(text):
+        start += offset
+        end += offset
+        if kind == 'open':
+            tag = HTML_TAGS[value]
+            pieces.append(('open', start, f'<{tag}>', f'</{tag}>'))
+        elif kind == 'close':
+            pieces.append(('close', start, f'</{HTML_TAGS[value]}>', None))
+        elif kind == 'code':
+            pieces.append(('open', start, '<code>', '</code>'))
+            pieces.extend(('text', start + 1 + i, escape_html(char), None) for i, char in enumerate(value))
+            pieces.append(('close', end - 1, '</code>', None))
+        elif kind == 'link':
+            label, url = value
+            url = escape_html(url).replace('"', '&quot;')
+            pieces.append(('open', start, f'<a href="{url}">', '</a>'))
+            _render_inline(label, start + 1, pieces)
+            pieces.append(('close', end - 1, '</a>', None))
+        else:
+            pieces.append(('text', start, escape_html(value), None))
+
+def _is_fence(line: str) -> bool:
+    return line.strip().startswith('```')
+
+@lru_cache(maxsize=64)
+def _render_pieces(text: str) -> list[Piece]:
+    """Renders the markdown into pieces of HTML that remember where in the text they come from, in the order of the text"""
+
+    pieces: list[Piece] = []
+    lines = text.split('\n')
+    # index of the piece that opens the current code block, with the language of the block
+    code_block: Optional[tuple[int, str]] = None
+    line_start = 0
+    for number, line in enumerate(lines):
+        is_last = number + 1 == len(lines)
+        if _is_fence(line):
+            if code_block is None:
+                code_block = (len(pieces), re.sub(r'\W', '', line.strip()[3:]))
+                pieces.append(('open', line_start, '<pre>', '</pre>'))
+                # the code starts right after the tag
+                is_last = True
+            else:
+                index, code_lang = code_block
+                if code_lang:
+                    pieces[index] = ('open', pieces[index][1], f'<pre><code class="language-{code_lang}">', '</code></pre>')
+                pieces.append(('close', line_start, pieces[index][3], None))
+                code_block = None
+        elif code_block is not None:
+            pieces.extend(('text', line_start + i, escape_html(char), None) for i, char in enumerate(line))
+            # the code ends right before the tag
+            is_last = is_last or _is_fence(lines[number + 1])
+        else:
+            heading = HEADING.match(line)
+            bullet = BULLET.match(line)
+            if heading:
+                pieces.append(('open', line_start, '<b>', '</b>'))
+                _render_inline(heading.group(1), line_start + heading.start(1), pieces)
+                pieces.append(('close', line_start + heading.end(1) - 1, '</b>', None))
+            elif bullet:
+                pieces.append(('text', line_start, bullet.group(1), None))
+                pieces.append(('text', line_start + bullet.end(1), '• ', None))
+                _render_inline(line[bullet.end():], line_start + bullet.end(), pieces)
+            else:
+                _render_inline(line, line_start, pieces)
+
+        if not is_last:
+            pieces.append(('text', line_start + len(line), '\n', None))
+        line_start += len(line) + 1
+
+    # a code block that is never closed is rendered till the end of the text
+    if code_block is not None:
+        pieces.append(('close', len(text), '</pre>', None))
+    return pieces
+
+@lru_cache(maxsize=1024)
+def render_markdown(text: str) -> str:
+    """
+    Converts markdown produced by the API service into Telegram HTML.
+    Everything is escaped and only balanced entities become tags, so Telegram never rejects the message.
+    """
+    return ''.join(html for _, _, html, _ in _render_pieces(text))
+
+def _render_span(pieces: list[Piece], start: int, end: int) -> str:
+    """Renders the part of the text between start and end, tags open at the start are reopened and tags left open are closed"""
+
+    # tags opened before the span and not closed yet
+    reopened: list[Piece] = []
+    inside: list[Piece] = []
+    for piece in pieces:
+        kind, position, _, _ = piece
+        if position >= end:
+            break
+        if position < start:
+            if kind == 'open':
+                reopened.append(piece)
+            elif kind == 'close':
+                reopened.pop()
+        elif kind == 'close' and reopened and not inside:
+            # a tag closed right at the start ends in the previous part
+            reopened.pop()
+        else:
+            inside.append(piece)
+
+    # a tag opened right at the end starts in the next part
+    while inside and inside[-1][0] == 'open':
+        inside.pop()
+
+    out = [html for _, _, html, _ in reopened]
+    opened = list(reopened)
+    for piece in inside:
+        if piece[0] == 'open':
+            opened.append(piece)
+        elif piece[0] == 'close':
+            opened.pop()
+        out.append(piece[2])
+    out.extend(closing for _, _, _, closing in reversed(opened))
+    return ''.join(out)
+
+def _parts(text: str, start: int, end: int, separator: re.Pattern) -> list[tuple[int, int]]:
+    """Returns the spans of text[start:end] between the separators"""
+
+    parts = []
+    position = start
+    for match in separator.finditer(text, start, end):
+        if match.start() > position:
+            parts.append((position, match.start()))
+        position = match.end()
+    if position < end:
+        parts.append((position, end))
+    return parts
+
+def _pack(text: str, start: int, end: int, limit: int, level: int = 0) -> list[tuple[int, int]]:
+    """
+    Greedily joins the parts of text[start:end] between the separators of the level into spans of at most limit characters.
+    Parts that don't fit are split at the next level, by characters in the end.
+    """
+
+    if level == len(SEPARATORS):
+        return [(i, min(i + limit, end)) for i in range(start, end, limit)]
+
+    spans = []
+    current = None
+    for part_start, part_end in _parts(text, start, end, SEPARATORS[level]):
+        if part_end - part_start > limit:
+            if current is not None:
+                spans.append(current)
+                current = None
+            spans.extend(_pack(text, part_start, part_end, limit, level + 1))
+        elif current is not None and part_end - current[0] <= limit:
+            current = (current[0], part_end)
+        else:
+            if current is not None:
+                spans.append(current)
+            current = (part_start, part_end)
+    if current is not None:
+        spans.append(current)
+    return spans
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[tuple[str, str]]:
+    """
+    Splits the text into Telegram messages, preferring paragraph, then line and then sentence boundaries.
+    Returns the markdown of every message with its HTML. The HTML is cut from the rendering of the whole text,
+    so entities are never parsed differently; tags that span a split are closed and reopened in the next message.
+    """
+
+    text = text.strip()
+    if not text:
+        return []
+    if len(text) <= limit:
+        return [(text, render_markdown(text))]
+
+    pieces = _render_pieces(text)
+    messages = []
+    for start, end in _pack(text, 0, len(text), limit):
+        html = _render_span(pieces, start, end)
+        if html.strip():
+            messages.append((text[start:end], html))
+    return messages
@@ -0,0 +1,7 @@
+import fakeredis
+import pytest
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeAsyncRedis()
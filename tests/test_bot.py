@@ -0,0 +1,203 @@
+import html
+import inspect
+import os
+import re
+from types import SimpleNamespace
+
+os.environ.setdefault('TG_BOT_TOKEN', '123456:test')
+
+import pytest
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import backend
+import bot
+from admission import Overloaded
+from backend import AssistantMessage, ChatReply, Profile, User, save_message_feedback
+from telegram_text import split_message
+from translated_messages import MESSAGES_DICT
+from utils import RegistrationStates, get_inline_feedback_buttons
+
+LONG_ANSWER = '\n\n'.join(f'**Step {i}.** Drink a glass of water_before every meal and take a short walk after it.' for i in range(120))
+
+
+def shown_text(rendered: str) -> str:
+    """The text of a sent HTML message as Telegram gives it back in a callback"""
+    return html.unescape(re.sub(r'<[^>]+>', '', rendered))
+
+
+class FakeClient:
+    def __init__(self):
+        self.patched = []
+
+    async def patch(self, url: str, **kwargs):
+        self.patched.append((url, kwargs['json']))
+        return FakeResponse()
+
+
+class FakeResponse:
+    def raise_for_status(self) -> None:
+        pass
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = []
+    enqueued = []
+
+    async def send_message(chat_id, text, parse_mode=None, reply_markup=None):
+        sent.append((text, reply_markup))
+
+    async def enqueue(kind, **payload):
+        enqueued.append((kind, payload))
+
+    monkeypatch.setattr(bot.bot, 'send_message', send_message)
+    monkeypatch.setattr(bot.outbox, 'enqueue', enqueue)
+    return sent, enqueued
+
+
+async def test_long_answer_is_saved_as_sent_with_buttons_on_the_last_part(sent):
+    sent, enqueued = sent
+    buttons = get_inline_feedback_buttons('en')
+
+    await bot.send_assistant_text(1, LONG_ANSWER, reply_markup=buttons, user_email='tg_1@example.com', thread_id='thread')
+
+    chunks = split_message(LONG_ANSWER)
+    assert len(chunks) > 1
+    assert [text for text, _ in sent] == [rendered for _, rendered in chunks]
+    assert [markup for _, markup in sent] == [None] * (len(chunks) - 1) + [buttons]
+    assert enqueued == [('assistant_message', {'user_email': 'tg_1@example.com', 'text': chunk, 'thread_id': 'thread'}) for chunk, _ in chunks]
+
+
+async def test_feedback_on_the_last_part_finds_the_saved_parts(sent, monkeypatch):
+    sent, enqueued = sent
+    await bot.send_assistant_text(1, LONG_ANSWER, reply_markup=get_inline_feedback_buttons('en'), user_email='tg_1@example.com', thread_id='thread')
+    saved = [AssistantMessage(id=i, message=payload['text']) for i, (_, payload) in enumerate(enqueued)]
+
+    async def list_assistant_messages(user_email, client):
+        return iter(reversed(saved))
+
+    monkeypatch.setattr(backend, 'list_assistant_messages', list_assistant_messages)
+    client = FakeClient()
+    await save_message_feedback('tg_1@example.com', shown_text(sent[-1][0]), 'positive_feedback', client)
+    assert client.patched == [(f'{backend.BACKEND_API_ENDPOINT}/users/tg_1@example.com/assistant_messages/{len(saved) - 1}', {'positive_feedback': True})]
+
+
+async def test_feedback_on_the_last_part_finds_a_whole_answer_saved_by_the_api(sent, monkeypatch):
+    sent, _ = sent
+    await bot.send_assistant_text(1, LONG_ANSWER, reply_markup=get_inline_feedback_buttons('en'))
+
+    async def list_assistant_messages(user_email, client):
+        return iter([AssistantMessage(id=7, message='Another answer'), AssistantMessage(id=3, message=LONG_ANSWER)])
+
+    monkeypatch.setattr(backend, 'list_assistant_messages', list_assistant_messages)
+    client = FakeClient()
+    await save_message_feedback('tg_1@example.com', shown_text(sent[-1][0]), 'negative_feedback', client)
+    assert client.patched == [(f'{backend.BACKEND_API_ENDPOINT}/users/tg_1@example.com/assistant_messages/3', {'negative_feedback': True})]
+
+
+async def test_feedback_on_an_unknown_message_is_retried(monkeypatch):
+    async def list_assistant_messages(user_email, client):
+        return iter([AssistantMessage(id=3, message='Something else')])
+
+    monkeypatch.setattr(backend, 'list_assistant_messages', list_assistant_messages)
+    with pytest.raises(backend.MessageNotFound):
+        await save_message_feedback('tg_1@example.com', 'Drink water', 'positive_feedback', FakeClient())
+
+
+@pytest.fixture
+def onboarded(sent, monkeypatch):
+    """A user who has just answered the last onboarding question"""
+
+    answers = []
+
+    async def answer(text, **kwargs):
+        answers.append(text)
+
+    async def send_chat_action(**kwargs):
+        pass
+
+    async def commit_registration(**kwargs):
+        pass
+
+    async def get_profile(user_email, client):
+        return Profile(preferred_lang='en')
+
+    async def get_user(user_email, client):
+        return User(id=1, email=user_email)
+
+    monkeypatch.setattr(bot, 'commit_registration', commit_registration)
+    monkeypatch.setattr(bot, 'get_profile', get_profile)
+    monkeypatch.setattr(bot, 'get_user', get_user)
+    monkeypatch.setattr(bot, 'advice_push_mode', lambda: True)
+
+    user = SimpleNamespace(id=1, first_name='Ann', full_name='Ann', username='ann')
+    message = SimpleNamespace(from_user=user, chat=SimpleNamespace(id=1), answer=answer, bot=SimpleNamespace(send_chat_action=send_chat_action))
+    state = FSMContext(MemoryStorage(), StorageKey(bot_id=1, chat_id=1, user_id=1))
+    return message, state, answers
+
+
+async def test_shed_initial_consultation_can_be_retried(onboarded, monkeypatch):
+    message, state, answers = onboarded
+
+    async def start_chat(user_email, client):
+        raise Overloaded('busy')
+
+    monkeypatch.setattr(bot, 'start_chat', start_chat)
+    await state.set_state(RegistrationStates.completed)
+    await state.set_data({'preferred_lang': 'en', 'description': ''})
+
+    await bot.all_saved(message, state)
+
+    assert answers[-1] == MESSAGES_DICT['busy']['en']
+    # the next message runs all_saved again
+    assert await state.get_state() == RegistrationStates.completed.state
+    assert 'thread_id' not in await state.get_data()
+
+
+async def test_started_initial_consultation_moves_to_consulting(onboarded, monkeypatch):
+    message, state, _ = onboarded
+
+    async def start_chat(user_email, client):
+        return ChatReply(text='Hello!', thread_id='thread')
+
+    monkeypatch.setattr(bot, 'start_chat', start_chat)
+    await state.set_state(RegistrationStates.completed)
+    await state.set_data({'preferred_lang': 'en', 'description': ''})
+
+    await bot.all_saved(message, state)
+
+    assert await state.get_state() == RegistrationStates.consulting.state
+    assert (await state.get_data())['thread_id'] == 'thread'
+
+
+@pytest.fixture
+def pregenerated(monkeypatch):
+    """Greeting pre-generation without the lease, with the due users it was asked for"""
+
+    pregenerated = []
+
+    async def pregenerate_greetings(telegram_ids, generate):
+        pregenerated.append(telegram_ids)
+
+    monkeypatch.setattr(bot, 'pregenerate_greetings', pregenerate_greetings)
+    monkeypatch.setattr(bot.scheduler, 'get_jobs', lambda: [])
+    monkeypatch.setattr(bot, 'due_telegram_ids', lambda jobs, lead: [(jobs, lead)])
+    return inspect.unwrap(bot.pregenerate_daily_greetings), pregenerated
+
+
+async def test_greetings_are_not_pregenerated_at_peak(pregenerated, monkeypatch):
+    pregenerate, pregenerated = pregenerated
+    monkeypatch.setattr(bot.chat_admission, 'interactive_load', lambda: 0.9)
+    await pregenerate()
+    assert pregenerated == []
+
+
+async def test_greetings_are_pregenerated_off_peak_for_the_next_delivery_only(pregenerated, monkeypatch):
+    pregenerate, pregenerated = pregenerated
+    monkeypatch.setattr(bot, 'GREETING_PREGEN_LEAD', 60 * 60)
+    monkeypatch.setattr(bot.chat_admission, 'interactive_load', lambda: 0.1)
+    await pregenerate()
+    [[(jobs, lead)]] = pregenerated
+    assert lead < bot.UPDATE_INTERVAL
@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from admission import Overloaded
+from coalescing import MessageCoalescer
+
+
+async def send(coalescer: MessageCoalescer, text: str, requests: list, error: Exception = None) -> str:
+    try:
+        async with coalescer.burst(1, text) as merged:
+            if merged is None:
+                return 'merged'
+            requests.append(merged)
+            if error is not None:
+                raise error
+            return 'sent'
+    except Overloaded:
+        return 'busy'
+
+
+async def test_burst_is_sent_as_one_request():
+    coalescer = MessageCoalescer(window=0.05, max_wait=1)
+    requests = []
+
+    outcomes = await asyncio.gather(send(coalescer, 'a', requests), send(coalescer, 'b', requests), send(coalescer, 'c', requests))
+
+    assert requests == ['a\nb\nc']
+    assert outcomes == ['sent', 'merged', 'merged']
+
+
+async def test_merged_messages_get_the_error_of_the_request():
+    coalescer = MessageCoalescer(window=0.05, max_wait=1)
+    requests = []
+
+    outcomes = await asyncio.gather(send(coalescer, 'a', requests, Overloaded('busy')), send(coalescer, 'b', requests), send(coalescer, 'c', requests))
+
+    assert requests == ['a\nb\nc']
+    assert outcomes == ['busy', 'busy', 'busy']
+
+
+async def test_next_burst_is_not_affected_by_an_error():
+    coalescer = MessageCoalescer(window=0.01, max_wait=1)
+    requests = []
+
+    assert await send(coalescer, 'a', requests, Overloaded('busy')) == 'busy'
+    assert await send(coalescer, 'b', requests) == 'sent'
+    assert requests == ['a', 'b']
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+from aiogram.types import Update
+
+import dedup
+from dedup import UpdateDeduplicationMiddleware
+
+
+@pytest.fixture
+def middleware(redis, monkeypatch):
+    monkeypatch.setattr(dedup, 'get_redis', lambda: redis)
+    return UpdateDeduplicationMiddleware()
+
+
+async def test_handled_update_is_dropped(middleware):
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.update_id)
+        return 'done'
+
+    assert await middleware(handler, Update(update_id=1), {}) == 'done'
+    assert await middleware(handler, Update(update_id=1), {}) is None
+    assert handled == [1]
+
+
+async def test_redelivery_during_a_slow_handler_is_dropped(middleware):
+    started = asyncio.Event()
+    release = asyncio.Event()
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.update_id)
+        started.set()
+        await release.wait()
+
+    first = asyncio.create_task(middleware(handler, Update(update_id=1), {}))
+    await started.wait()
+    await asyncio.wait_for(middleware(handler, Update(update_id=1), {}), timeout=1)
+    release.set()
+    await first
+    assert handled == [1]
+
+
+async def test_failed_update_is_handled_again(middleware):
+    handled = []
+
+    async def failing(event, data):
+        handled.append(event.update_id)
+        raise RuntimeError('failed')
+
+    async def handler(event, data):
+        handled.append(event.update_id)
+
+    with pytest.raises(RuntimeError):
+        await middleware(failing, Update(update_id=1), {})
+    await middleware(handler, Update(update_id=1), {})
+    assert handled == [1, 1]
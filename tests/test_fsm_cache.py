@@ -0,0 +1,85 @@
+import asyncio
+
+import fakeredis
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+
+from fsm_cache import CachedRedisStorage
+
+KEY = StorageKey(bot_id=1, chat_id=2, user_id=2)
+
+
+@pytest.fixture
+async def instances():
+    """Two bot instances sharing one Redis, with their invalidation listeners running"""
+
+    server = fakeredis.FakeServer()
+    storages = [CachedRedisStorage(RedisStorage(redis=fakeredis.FakeAsyncRedis(server=server))) for _ in range(2)]
+    listeners = [asyncio.create_task(storage.listen()) for storage in storages]
+    while not all(storage._listening for storage in storages):
+        await asyncio.sleep(0.01)
+    yield storages
+    # idle listeners, so the cancellation doesn't race with a message
+    await asyncio.sleep(0.05)
+    for listener in listeners:
+        listener.cancel()
+    await asyncio.gather(*listeners, return_exceptions=True)
+
+
+async def wait_for_invalidation(storage: CachedRedisStorage) -> None:
+    cache_key = storage._cache_key(KEY)
+    for _ in range(100):
+        if cache_key not in storage._entries:
+            return
+        await asyncio.sleep(0.01)
+
+
+async def test_reads_are_served_from_memory(instances):
+    first, _ = instances
+    await first.set_data(KEY, {'thread_id': 't1'})
+
+    assert await first.get_data(KEY) == {'thread_id': 't1'}
+    assert await first.get_data(KEY) == {'thread_id': 't1'}
+    assert (first.hits, first.misses) == (2, 0)
+
+
+async def test_returned_data_is_a_copy(instances):
+    first, _ = instances
+    await first.set_data(KEY, {'notes': ''})
+    data = await first.get_data(KEY)
+    data['notes'] = 'changed'
+    assert await first.get_data(KEY) == {'notes': ''}
+
+
+async def test_writes_invalidate_the_other_instances(instances):
+    first, second = instances
+    await first.set_state(KEY, 'RegistrationStates:consulting')
+    assert await second.get_state(KEY) == 'RegistrationStates:consulting'
+
+    await first.set_state(KEY, 'DailyCheckStates:waiting_for_notes')
+    await wait_for_invalidation(second)
+    assert await second.get_state(KEY) == 'DailyCheckStates:waiting_for_notes'
+
+
+async def test_write_that_raced_with_an_invalidation_is_not_cached(instances):
+    first, _ = instances
+    set_state = first.storage.set_state
+
+    async def set_state_racing(key, state):
+        await set_state(key, state)
+        # an invalidation from another instance arrives while the write is in flight
+        first._invalidate(first._cache_key(key))
+
+    first.storage.set_state = set_state_racing
+    await first.set_state(KEY, 'RegistrationStates:consulting')
+    assert first._cache_key(KEY) not in first._entries
+    assert await first.get_state(KEY) == 'RegistrationStates:consulting'
+
+
+async def test_cache_is_bypassed_without_the_listener():
+    storage = CachedRedisStorage(RedisStorage(redis=fakeredis.FakeAsyncRedis()))
+    await storage.set_data(KEY, {'thread_id': 't1'})
+    assert await storage.get_data(KEY) == {'thread_id': 't1'}
+    assert storage._entries == {}
+    assert storage.hits == 0
@@ -0,0 +1,103 @@
+import asyncio
+import time
+
+import pytest
+
+import lookup_cache
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch, redis):
+    monkeypatch.setattr(lookup_cache, 'get_redis', lambda: redis)
+    monkeypatch.setattr(lookup_cache, '_entries', type(lookup_cache._entries)())
+    monkeypatch.setattr(lookup_cache, '_listening', True)
+
+
+def test_lookups_expire_one_by_one(monkeypatch):
+    monkeypatch.setattr(lookup_cache, 'LOOKUP_CACHE_TTL', 10)
+    lookup_cache.put('a@dummy.com', fetched=time.time() - 20, user={'id': 1})
+    lookup_cache.put('a@dummy.com', profile={'preferred_lang': 'en'})
+
+    assert lookup_cache.get('a@dummy.com', 'user') is None
+    assert lookup_cache.get('a@dummy.com', 'profile') == {'preferred_lang': 'en'}
+
+
+def test_least_recently_used_users_are_evicted(monkeypatch):
+    monkeypatch.setattr(lookup_cache, 'LOOKUP_CACHE_SIZE', 2)
+    lookup_cache.put('a', user={'id': 1})
+    lookup_cache.put('b', user={'id': 2})
+    assert lookup_cache.get('a', 'user') == {'id': 1}
+    lookup_cache.put('c', user={'id': 3})
+
+    assert lookup_cache.get('b', 'user') is None
+    assert lookup_cache.get('a', 'user') == {'id': 1}
+    assert lookup_cache.get('c', 'user') == {'id': 3}
+
+
+def test_cache_is_bypassed_without_the_listener(monkeypatch):
+    lookup_cache.put('a', user={'id': 1})
+    monkeypatch.setattr(lookup_cache, '_listening', False)
+    assert lookup_cache.get('a', 'user') is None
+
+
+def test_lookup_that_raced_with_an_invalidation_is_not_cached():
+    generation = lookup_cache.generation()
+    lookup_cache.invalidate('a')
+    lookup_cache.put('a', since=generation, user={'id': 1})
+    assert lookup_cache.get('a', 'user') is None
+
+
+async def test_snapshots_of_instances_are_merged_and_keep_their_age(monkeypatch, redis):
+    monkeypatch.setattr(lookup_cache, 'LOOKUP_CACHE_TTL', 100)
+    lookup_cache.put('a', user={'id': 1})
+    lookup_cache.put('expired', fetched=time.time() - 200, user={'id': 0})
+    await lookup_cache.save_snapshot()
+
+    # another instance with other users
+    lookup_cache._entries.clear()
+    fetched = time.time() - 50
+    lookup_cache.put('b', fetched=fetched, user={'id': 2})
+    await lookup_cache.save_snapshot()
+    assert sorted(await redis.hkeys(lookup_cache.WARM_START_KEY)) == [b'a', b'b']
+
+    lookup_cache._entries.clear()
+    assert sorted(await lookup_cache.load_snapshot()) == ['a', 'b']
+    assert lookup_cache.get('a', 'user') == {'id': 1}
+    assert lookup_cache._entries['b']['user'] == ({'id': 2}, fetched)
+
+
+async def test_expired_users_are_dropped_from_the_snapshot(monkeypatch, redis):
+    monkeypatch.setattr(lookup_cache, 'LOOKUP_CACHE_TTL', 100)
+    lookup_cache.put('a', fetched=time.time() - 60, user={'id': 1})
+    await lookup_cache.save_snapshot()
+    monkeypatch.setattr(lookup_cache, 'LOOKUP_CACHE_TTL', 30)
+
+    lookup_cache._entries.clear()
+    assert await lookup_cache.load_snapshot() == []
+    assert await redis.hkeys(lookup_cache.WARM_START_KEY) == []
+
+
+async def test_invalidations_reach_the_other_instances(monkeypatch, redis):
+    listener = asyncio.create_task(lookup_cache.listen())
+    await asyncio.sleep(0.05)
+    lookup_cache.put('a', user={'id': 1}, profile={'preferred_lang': 'en'})
+    await lookup_cache.save_snapshot()
+
+    # published by another instance
+    await redis.publish(lookup_cache.LOOKUP_INVALIDATION_CHANNEL, 'a')
+    for _ in range(50):
+        if lookup_cache.get('a', 'profile') is None:
+            break
+        await asyncio.sleep(0.01)
+    assert lookup_cache.get('a', 'profile') is None
+
+    lookup_cache.put('a', user={'id': 1})
+    await lookup_cache.publish_invalidation('a')
+    assert lookup_cache.get('a', 'user') is None
+    assert await redis.hkeys(lookup_cache.WARM_START_KEY) == []
+
+    # let the listener take its own message before it is stopped
+    await asyncio.sleep(0.05)
+    listener.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await listener
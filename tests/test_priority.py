@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from priority import PriorityLimiter, INTERACTIVE, BATCH, current_lane, batch_job
+
+
+async def test_batch_lane_cannot_take_the_reserved_slots():
+    limiter = PriorityLimiter('test', capacity=3, reserved=1)
+    await limiter.acquire(BATCH)
+    await limiter.acquire(BATCH)
+
+    waiting = asyncio.create_task(limiter.acquire(BATCH))
+    await asyncio.sleep(0)
+    assert not waiting.done()
+    # the reserved slot is still free for interactive work
+    await limiter.acquire(INTERACTIVE)
+    assert limiter.stats() == {'interactive_running': 1, 'batch_running': 2, 'interactive_waiting': 0, 'batch_waiting': 1}
+
+    # a batch slot frees up, but the interactive work still keeps the batch lane below its share
+    limiter.release(BATCH)
+    await asyncio.sleep(0)
+    assert not waiting.done()
+    limiter.release(INTERACTIVE)
+    await asyncio.wait_for(waiting, 1)
+    assert limiter.in_use == {INTERACTIVE: 0, BATCH: 2}
+
+
+async def test_interactive_waiters_go_first():
+    limiter = PriorityLimiter('test', capacity=3, reserved=1)
+    for _ in range(3):
+        await limiter.acquire(INTERACTIVE)
+
+    order = []
+
+    async def acquire(lane: str) -> None:
+        await limiter.acquire(lane)
+        order.append(lane)
+
+    batch = asyncio.create_task(acquire(BATCH))
+    await asyncio.sleep(0)
+    interactive = asyncio.create_task(acquire(INTERACTIVE))
+    await asyncio.sleep(0)
+
+    limiter.release(INTERACTIVE)
+    await asyncio.wait_for(interactive, 1)
+    assert order == [INTERACTIVE]
+    # the batch lane only gets what is left over the reserve
+    limiter.release(INTERACTIVE)
+    await asyncio.sleep(0)
+    assert order == [INTERACTIVE]
+    limiter.release(INTERACTIVE)
+    await asyncio.wait_for(batch, 1)
+    assert order == [INTERACTIVE, BATCH]
+    assert limiter.in_use == {INTERACTIVE: 1, BATCH: 1}
+
+
+async def test_cancelled_waiter_leaves_no_trace():
+    limiter = PriorityLimiter('test', capacity=1, reserved=0)
+    await limiter.acquire(INTERACTIVE)
+
+    waiting = asyncio.create_task(limiter.acquire(INTERACTIVE))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+
+    limiter.release(INTERACTIVE)
+    assert limiter.stats() == {'interactive_running': 0, 'batch_running': 0, 'interactive_waiting': 0, 'batch_waiting': 0}
+
+
+async def test_slot_uses_the_lane_of_the_context():
+    limiter = PriorityLimiter('test', capacity=2, reserved=1)
+    lanes = []
+
+    @batch_job
+    async def job() -> None:
+        async with limiter.slot():
+            lanes.append(current_lane.get())
+            assert limiter.in_use == {INTERACTIVE: 0, BATCH: 1}
+
+    await job()
+    assert lanes == [BATCH]
+    assert current_lane.get() == INTERACTIVE
+    assert limiter.in_use == {INTERACTIVE: 0, BATCH: 0}
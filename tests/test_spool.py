@@ -0,0 +1,61 @@
+import os
+import time
+
+from spool import AudioSpool, AUDIO_SPOOL_STALE_AGE
+
+
+def spool_file(directory: str, name: str, size: int = 10, age: float = 0.0) -> str:
+    path = os.path.join(directory, f'audio{name}')
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    modified = time.time() - age
+    os.utime(path, (modified, modified))
+    return path
+
+def age_directory(directory: str, age: float) -> None:
+    modified = time.time() - age
+    os.utime(directory, (modified, modified))
+
+
+def test_sweep_leaves_the_files_of_running_instances(tmp_path):
+    running = AudioSpool(str(tmp_path))
+    in_use = spool_file(running.directory, '1.mp3')
+
+    AudioSpool(str(tmp_path)).sweep()
+    assert os.path.exists(in_use)
+
+
+def test_sweep_removes_stale_instances_and_old_files(tmp_path):
+    crashed = AudioSpool(str(tmp_path))
+    spool_file(crashed.directory, '1.mp3', age=AUDIO_SPOOL_STALE_AGE + 60)
+    age_directory(crashed.directory, AUDIO_SPOOL_STALE_AGE + 60)
+    old = spool_file(str(tmp_path), '2.mp3', age=AUDIO_SPOOL_STALE_AGE + 60)
+    recent = spool_file(str(tmp_path), '3.mp3')
+
+    assert AudioSpool(str(tmp_path)).sweep() == 2
+    assert not os.path.exists(crashed.directory)
+    assert not os.path.exists(old)
+    assert os.path.exists(recent)
+
+
+async def test_eviction_stays_in_the_own_directory(tmp_path):
+    other = AudioSpool(str(tmp_path), max_bytes=100)
+    others_file = spool_file(other.directory, '1.mp3', size=80, age=60)
+    spool = AudioSpool(str(tmp_path), max_bytes=100)
+    stale = spool_file(spool.directory, '2.mp3', size=80, age=60)
+
+    async with spool.file('3.mp3', size=50) as path:
+        assert os.path.dirname(path) == spool.directory
+        assert not os.path.exists(stale)
+        assert os.path.exists(others_file)
+
+
+async def test_directory_removed_by_a_sweep_is_recreated(tmp_path):
+    spool = AudioSpool(str(tmp_path))
+    age_directory(spool.directory, AUDIO_SPOOL_STALE_AGE + 60)
+    AudioSpool(str(tmp_path)).sweep()
+    assert not os.path.exists(spool.directory)
+
+    async with spool.file('1.mp3') as path:
+        open(path, 'wb').close()
+    assert os.path.isdir(spool.directory)
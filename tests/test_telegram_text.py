@@ -0,0 +1,87 @@
+from telegram_text import split_message, render_markdown
+
+
+def test_short_text_is_one_message():
+    assert split_message('  Hello **you**!  ') == [('Hello **you**!', 'Hello <b>you</b>!')]
+    assert split_message('') == []
+
+
+def test_split_prefers_paragraphs():
+    first, second = 'a' * 60, 'b' * 60
+    assert split_message(f'{first}\n\n{second}', limit=100) == [(first, first), (second, second)]
+
+
+def test_long_paragraph_is_split_by_sentences():
+    text = ' '.join(['This is a sentence.'] * 20)
+    chunks = [chunk for chunk, _ in split_message(text, limit=100)]
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert all(chunk.endswith('.') for chunk in chunks)
+    assert ' '.join(chunks) == text
+
+
+def test_entities_are_closed_and_reopened_across_chunks():
+    text = '**' + ' '.join(['bold words here.'] * 20) + '**'
+    messages = split_message(text, limit=100)
+    assert len(messages) > 1
+    for _, html in messages:
+        assert html.startswith('<b>') and html.endswith('</b>')
+        assert html.count('<b>') == html.count('</b>') == 1
+
+
+def test_snake_case_across_chunks_stays_plain():
+    text = 'Call my_function first. ' + ' '.join(['Then keep _going_ on.'] * 20)
+    messages = split_message(text, limit=80)
+    assert len(messages) > 1
+    assert messages[0][1].startswith('Call my_function first.')
+    for _, html in messages:
+        assert html.count('<i>') == html.count('going') == html.count('</i>')
+        assert '_' not in html.replace('my_function', '')
+
+
+def test_bullet_list_across_chunks_keeps_its_items():
+    text = '\n'.join(f'* item {i} with **bold {i}** text' for i in range(10))
+    messages = split_message(text, limit=100)
+    assert len(messages) > 1
+    for chunk, html in messages:
+        assert all(line.startswith('* item') for line in chunk.split('\n'))
+        assert all(line.startswith('• item') for line in html.split('\n'))
+        assert '*' not in html
+
+
+def test_code_block_across_chunks_is_reopened():
+    text = '```python\n' + '\n'.join(f'x_{i} = {i} * 2' for i in range(30)) + '\n```\nDone.'
+    messages = split_message(text, limit=150)
+    assert len(messages) > 1
+    for _, html in messages[:-1]:
+        assert html.startswith('<pre><code class="language-python">') and html.endswith('</code></pre>')
+    assert messages[-1][1].endswith('</code></pre>\nDone.')
+
+
+def test_markers_next_to_a_split_are_rendered_as_in_the_whole_text():
+    text = ' '.join(['word'] * 30) + ' _see __init__ and __main__ there_'
+    assert render_markdown(text).endswith('<i>see <b>init</b> and <b>main</b> there</i>')
+    messages = split_message(text, limit=40)
+    assert messages[-2] == ('word word word word word word _see', 'word word word word word word <i>see</i>')
+    assert messages[-1] == ('__init__ and __main__ there_', '<i><b>init</b> and <b>main</b> there</i>')
+
+
+def test_render_inline_markdown():
+    assert render_markdown('**bold** and _italic_ and `a < b`') == '<b>bold</b> and <i>italic</i> and <code>a &lt; b</code>'
+
+
+def test_render_escapes_html_and_keeps_unbalanced_markers():
+    assert render_markdown('1 < 2 & *not bold') == '1 &lt; 2 &amp; *not bold'
+
+
+def test_render_keeps_snake_case():
+    assert render_markdown('use snake_case_names') == 'use snake_case_names'
+
+
+def test_render_headings_bullets_links_and_code_blocks():
+    text = '# Title\n- item\n[site](https://example.com)\n```python\nx = 1 < 2\n```'
+    assert render_markdown(text) == '\n'.join([
+        '<b>Title</b>',
+        '• item',
+        '<a href="https://example.com">site</a>',
+        '<pre><code class="language-python">x = 1 &lt; 2</code></pre>',
+    ])
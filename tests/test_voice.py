@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+from pydub import AudioSegment
+from pydub.generators import Sine
+
+import voice
+from voice import find_cut_points, merge_transcripts, transcribe_buffer, CircuitBreaker, TranscriptionBackend, LONG_AUDIO_OVERLAP
+
+
+def tone(ms: int) -> AudioSegment:
+    return Sine(440).to_audio_segment(duration=ms, volume=-10)
+
+
+def test_cut_at_silence_is_not_overlapped():
+    audio = tone(19000) + AudioSegment.silent(duration=1000) + tone(19000)
+    bounds = find_cut_points(audio, 20000)
+
+    assert len(bounds) == 2
+    (first_start, first_end, first_overlapped), (second_start, second_end, second_overlapped) = bounds
+    assert first_start == 0 and second_end == len(audio)
+    assert first_end == second_start
+    assert 19000 <= first_end <= 20000
+    assert not first_overlapped and not second_overlapped
+
+
+def test_hard_cut_is_overlapped():
+    audio = tone(40000)
+    bounds = find_cut_points(audio, 20000)
+
+    assert len(bounds) == 2
+    (_, first_end, first_overlapped), (second_start, _, second_overlapped) = bounds
+    assert first_end - second_start == LONG_AUDIO_OVERLAP
+    assert not first_overlapped and second_overlapped
+
+
+def test_merge_drops_words_repeated_at_a_hard_cut():
+    assert merge_transcripts(['we went to the', 'to the park'], [False, True]) == 'we went to the park'
+
+
+def test_merge_ignores_case_and_punctuation_at_a_hard_cut():
+    assert merge_transcripts(['I said hello,', 'Hello there'], [False, True]) == 'I said hello, there'
+
+
+def test_merge_keeps_repeats_around_a_silence_cut():
+    assert merge_transcripts(['I said no', 'no and that was it'], [False, False]) == 'I said no no and that was it'
+    assert merge_transcripts(['give me the', 'the other one'], [False, False]) == 'give me the the other one'
+
+
+class FakeBackend(TranscriptionBackend):
+    def __init__(self, name: str, error: Exception = None, delay: float = 0.0, is_available: bool = True):
+        self.name = name
+        self.error = error
+        self.delay = delay
+        self.is_available = is_available
+        self.calls = 0
+
+    def available(self) -> bool:
+        return self.is_available
+
+    async def transcribe(self, buffer_data: bytes, lang: str) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.name
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    deepgram_backend = FakeBackend('deepgram')
+    local_backend = FakeBackend('local')
+    monkeypatch.setattr(voice, 'deepgram_backend', deepgram_backend)
+    monkeypatch.setattr(voice, 'local_backend', local_backend)
+    monkeypatch.setattr(voice, 'deepgram_circuit', CircuitBreaker(threshold=2, cooldown=60))
+    monkeypatch.setattr(voice, 'LOCAL_STT_MAX_SHORT', 0)
+    return deepgram_backend, local_backend
+
+
+def test_circuit_opens_after_threshold_and_lets_a_trial_through(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(voice.time, 'monotonic', lambda: now[0])
+    circuit = CircuitBreaker(threshold=2, cooldown=10)
+
+    circuit.record_failure()
+    assert not circuit.is_open()
+    circuit.record_failure()
+    assert circuit.is_open()
+
+    now[0] += 10
+    # the trial call
+    assert not circuit.is_open()
+    assert circuit.is_open()
+
+    circuit.record_success()
+    assert not circuit.is_open()
+
+
+async def test_deepgram_is_used_by_default(backends):
+    deepgram_backend, local_backend = backends
+    assert await transcribe_buffer(b'audio', 'en', 10) == 'deepgram'
+    assert local_backend.calls == 0
+
+
+async def test_short_notes_go_to_the_local_engine(backends, monkeypatch):
+    deepgram_backend, _ = backends
+    monkeypatch.setattr(voice, 'LOCAL_STT_MAX_SHORT', 5)
+    assert await transcribe_buffer(b'audio', 'en', 3) == 'local'
+    assert await transcribe_buffer(b'audio', 'en', 10) == 'deepgram'
+    assert deepgram_backend.calls == 1
+
+
+async def test_failures_fall_back_and_open_the_circuit(backends):
+    deepgram_backend, local_backend = backends
+    deepgram_backend.error = RuntimeError('unavailable')
+
+    assert await transcribe_buffer(b'audio', 'en') == 'local'
+    assert await transcribe_buffer(b'audio', 'en') == 'local'
+    assert deepgram_backend.calls == 2
+    # the circuit is open, Deepgram is not called any more
+    assert await transcribe_buffer(b'audio', 'en') == 'local'
+    assert deepgram_backend.calls == 2
+    assert local_backend.calls == 3
+
+
+async def test_timeouts_fall_back(backends, monkeypatch):
+    deepgram_backend, _ = backends
+    deepgram_backend.delay = 1
+    monkeypatch.setattr(voice, 'DEEPGRAM_TIMEOUT', 0.01)
+    assert await transcribe_buffer(b'audio', 'en') == 'local'
+
+
+async def test_failures_are_raised_without_the_local_engine(backends):
+    deepgram_backend, local_backend = backends
+    deepgram_backend.error = RuntimeError('unavailable')
+    local_backend.is_available = False
+    with pytest.raises(RuntimeError):
+        await transcribe_buffer(b'audio', 'en')
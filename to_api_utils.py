@@ -1,14 +1,21 @@
 """Functions to interact with the API service. These functions are actually not gelegram specific."""
 
 from typing import Optional
+from collections import deque
 
 from dotenv import load_dotenv
+import asyncio
+import logging
 import os
+import time
 import httpx
+import orjson
 from retry import retry
 from contextlib import asynccontextmanager
 
 from utils import generate_dummy_email
+import lookup_cache
+from priority import PriorityLimiter, PriorityTransport
 
 load_dotenv()
 
@@ -18,28 +25,124 @@ HEADERS = {
 BACKEND_API_ENDPOINT = os.getenv('BACKEND_API_ENDPOINT')
 
 RETRY = httpx.AsyncHTTPTransport(retries=2)
+# Requests to the API service running at once, and how many of them scheduled jobs can't take
+BACKEND_MAX_CONCURRENT = int(os.getenv('BACKEND_MAX_CONCURRENT', 64))
+BACKEND_INTERACTIVE_RESERVED = int(os.getenv('BACKEND_INTERACTIVE_RESERVED', 16))
+BACKEND_LIMITER = PriorityLimiter('backend', BACKEND_MAX_CONCURRENT, BACKEND_INTERACTIVE_RESERVED)
+# Transport of all the API clients, replaced by a stub in load replays
+_transport: httpx.AsyncBaseTransport = PriorityTransport(RETRY, BACKEND_LIMITER)
+
+# Timeout profiles per endpoint class: cheap lookups should not get the same patience as LLM-backed chat calls
+LOOKUP_TIMEOUT = httpx.Timeout(float(os.getenv('BACKEND_LOOKUP_TIMEOUT', 10.0)))
+WRITE_TIMEOUT = httpx.Timeout(float(os.getenv('BACKEND_WRITE_TIMEOUT', 30.0)))
+CHAT_TIMEOUT = httpx.Timeout(float(os.getenv('BACKEND_CHAT_TIMEOUT', 120.0)))
+
+# Hedging of idempotent lookups: a second request is fired if the first one is slower than the observed p95
+HEDGE_ENABLED = os.getenv('BACKEND_HEDGE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+HEDGE_DEFAULT_DELAY = float(os.getenv('BACKEND_HEDGE_DEFAULT_DELAY', 0.5))
+HEDGE_MIN_DELAY = float(os.getenv('BACKEND_HEDGE_MIN_DELAY', 0.05))
+HEDGE_MIN_SAMPLES = 20
 
 def get_random_string(length: int) -> str:
     """Generates a random string of the given length"""
     return os.urandom(length).hex()
 
+class LatencyTracker:
+    """Keeps a window of recent request latencies to derive the hedging delay"""
+
+    def __init__(self, window: int = 500):
+        self.samples = deque(maxlen=window)
+
+    def add(self, latency: float) -> None:
+        self.samples.append(latency)
+
+    def p95(self) -> Optional[float]:
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+LATENCIES: dict[str, LatencyTracker] = {}
+
+def hedge_delay(endpoint: str) -> float:
+    """Returns how long to wait for the first request before firing a hedge"""
+    tracker = LATENCIES.get(endpoint)
+    p95 = tracker.p95() if tracker is not None else None
+    if p95 is None:
+        return HEDGE_DEFAULT_DELAY
+    return max(HEDGE_MIN_DELAY, p95)
+
+def set_transport(transport: httpx.AsyncBaseTransport) -> None:
+    """Routes the API clients through another transport, e.g. httpx.MockTransport"""
+    global _transport
+    _transport = PriorityTransport(transport, BACKEND_LIMITER)
+
 @asynccontextmanager
 async def get_async_client():
-    async with httpx.AsyncClient(transport=RETRY, timeout=120.0) as client:
+    async with httpx.AsyncClient(transport=_transport, timeout=CHAT_TIMEOUT) as client:
         yield client
 
+async def _timed_get(client: httpx.AsyncClient, url: str, endpoint: str, **kwargs) -> httpx.Response:
+    start = time.monotonic()
+    response = await client.get(url, **kwargs)
+    latency = time.monotonic() - start
+    LATENCIES.setdefault(endpoint, LatencyTracker()).add(latency)
+    logging.debug("Backend lookup finished", extra={'endpoint': endpoint, 'latency': round(latency, 3)})
+    return response
+
+async def hedged_get(client: httpx.AsyncClient, url: str, endpoint: str = 'lookup', **kwargs) -> httpx.Response:
+    """
+    GET for idempotent backend lookups with the lookup timeout profile.
+    If the first request is not answered within the p95 latency of the endpoint, a second one is fired and the first response wins.
+    """
+
+    kwargs.setdefault('timeout', LOOKUP_TIMEOUT)
+    if not HEDGE_ENABLED:
+        return await _timed_get(client, url, endpoint, **kwargs)
+
+    first = asyncio.create_task(_timed_get(client, url, endpoint, **kwargs))
+    done, _ = await asyncio.wait({first}, timeout=hedge_delay(endpoint))
+    if done:
+        return first.result()
+
+    second = asyncio.create_task(_timed_get(client, url, endpoint, **kwargs))
+    pending = {first, second}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            succeeded = [task for task in done if task.exception() is None]
+            if succeeded:
+                return succeeded[0].result()
+            # a failed request only matters if the other one fails too
+            if not pending:
+                return done.pop().result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+def decode(response: httpx.Response):
+    """Checks the status and decodes the body, the only place where responses are parsed"""
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
 @retry(tries=2)
-async def save_user_form(registration_form: dict, client: httpx.AsyncClient):
-    """Creates a user through the API or updates the existing one"""
+async def save_user_form(registration_form: dict, client: httpx.AsyncClient) -> tuple[Optional[int], bool]:
+    """Creates a user through the API or updates the existing one, returns the user id (if the API reports it) and whether the user was created"""
 
     # if there is no email, generate dummy email
     if not registration_form.get('email'):
         registration_form['email'] = generate_dummy_email('tg', registration_form['external_id'])
 
     # skip if user exists
-    response = await client.get(f'{BACKEND_API_ENDPOINT}/users/email/{registration_form["email"]}', headers=HEADERS)
+    cached_user = lookup_cache.get(registration_form['email'], 'user')
+    if cached_user is not None:
+        return cached_user['id'], False
+    generation = lookup_cache.generation()
+    response = await hedged_get(client, f'{BACKEND_API_ENDPOINT}/users/email/{registration_form["email"]}', endpoint='user_by_email', headers=HEADERS)
     if response.status_code == 200:
-        return
+        user = decode(response)
+        lookup_cache.put(registration_form['email'], since=generation, user={'id': user['id'], 'email': user['email']})
+        return user['id'], False
     else:
 
         if not registration_form.get('password'):
@@ -50,32 +153,58 @@ async def save_user_form(registration_form: dict, client: httpx.AsyncClient):
         user_data = {key: registration_form.get(key) for key in user_fields if registration_form.get(key) is not None}
 
         # send the user data to the API
-        response = await client.post(f'{BACKEND_API_ENDPOINT}/users', json=user_data, headers=HEADERS)
-        response.raise_for_status()
+        response = await client.post(f'{BACKEND_API_ENDPOINT}/users', json=user_data, headers=HEADERS, timeout=WRITE_TIMEOUT)
 
         # TODO DON'T LOG PASSWORDS!!!
+        return decode(response).get('id'), True
 
 @retry(tries=2)
-async def set_profile_fields(profile_fields: dict, user_id: Optional[dict]=None, user_email: Optional[str]=None, client: httpx.AsyncClient=None):
-    """Saves the user profile fields to the API"""
+async def set_profile_fields(profile_fields: dict, user_id: Optional[dict]=None, user_email: Optional[str]=None, client: httpx.AsyncClient=None, profile_exists: Optional[bool]=None):
+    """Saves the user profile fields to the API, profile_exists skips the lookup if it is already known"""
 
     response = None
     if user_id is None and user_email is not None:
-        response = await client.get(f'{BACKEND_API_ENDPOINT}/users/email/{user_email}', headers=HEADERS)
-        response.raise_for_status()
-        user_id = response.json()['id']
+        response = await hedged_get(client, f'{BACKEND_API_ENDPOINT}/users/email/{user_email}', endpoint='user_by_email', headers=HEADERS)
+        user_id = decode(response)['id']
 
     # extract only profile fields from the registration form
     profile_fields_keys = ['name', 'preferred_lang', 'birth_date', 'sex', 'mass', 'height', 'eats_meat', 'eats_fish', 'eats_dairy', 'description', 'initial_summary', 'tg_username']
     profile_fields = {key: profile_fields.get(key) for key in profile_fields_keys if profile_fields.get(key) is not None}
 
+    # a user that was just created has no profile yet
+    if profile_exists is False:
+        inner_response = await client.post(f'{BACKEND_API_ENDPOINT}/users/{user_id}/profile', json=profile_fields, headers=HEADERS, timeout=WRITE_TIMEOUT)
+        inner_response.raise_for_status()
+        return
+
     # create profile if it doesn't exist
-    response = await client.get(f'{BACKEND_API_ENDPOINT}/users/{user_id}/profile', headers=HEADERS)
+    response = await hedged_get(client, f'{BACKEND_API_ENDPOINT}/users/{user_id}/profile', endpoint='profile', headers=HEADERS)
     if response.status_code == 404:
-        inner_response = await client.post(f'{BACKEND_API_ENDPOINT}/users/{user_id}/profile', json=profile_fields, headers=HEADERS)
+        inner_response = await client.post(f'{BACKEND_API_ENDPOINT}/users/{user_id}/profile', json=profile_fields, headers=HEADERS, timeout=WRITE_TIMEOUT)
         inner_response.raise_for_status()
     elif response.status_code == 200:
-        inner_response = await client.patch(f'{BACKEND_API_ENDPOINT}/users/{user_id}/profile', json=profile_fields, headers=HEADERS)
+        inner_response = await client.patch(f'{BACKEND_API_ENDPOINT}/users/{user_id}/profile', json=profile_fields, headers=HEADERS, timeout=WRITE_TIMEOUT)
         inner_response.raise_for_status()
     else:
-        response.raise_for_status()
\ No newline at end of file
+        response.raise_for_status()
+
+async def commit_registration(registration_form: dict, profile_fields: dict, client: httpx.AsyncClient, saved_user: Optional[tuple[Optional[int], bool]] = None) -> None:
+    """
+    Commits all the fields collected during onboarding at once.
+    saved_user is the result of save_user_form if the user was already saved in the background, otherwise the user is saved here.
+    """
+
+    if saved_user is None:
+        saved_user = await save_user_form(registration_form=registration_form, client=client)
+    user_id, created = saved_user
+
+    # a cached profile was seen recently, the lookup before the update is not needed
+    profile_exists = False if created else (True if lookup_cache.get(registration_form['email'], 'profile') is not None else None)
+    try:
+        if user_id is None:
+            await set_profile_fields(profile_fields=profile_fields, user_email=registration_form['email'], client=client, profile_exists=profile_exists)
+        else:
+            await set_profile_fields(profile_fields=profile_fields, user_id=user_id, client=client, profile_exists=profile_exists)
+    finally:
+        # the other instances may have the old language cached
+        await lookup_cache.publish_invalidation(registration_form['email'])
@@ -0,0 +1,140 @@
+"""Sentry setup: sampling driven by configuration that keeps slow and failed traces, and spans around the I/O stages."""
+
+from typing import Any, Awaitable, Callable, Optional
+from datetime import datetime
+from dotenv import load_dotenv
+
+import functools
+import os
+import random
+
+import sentry_sdk
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.methods.base import TelegramMethod, TelegramType, Response
+from aiogram.types import TelegramObject, Update
+
+load_dotenv()
+
+SENTRY_DSN = os.getenv('SENTRY_DSN')
+SENTRY_ENVIRONMENT = os.getenv('SENTRY_ENVIRONMENT', 'production')
+# Share of updates and jobs that are traced in process, whether a trace is sent is decided when it finishes
+SENTRY_TRACES_RECORD_RATE = float(os.getenv('SENTRY_TRACES_RECORD_RATE', 1.0))
+# Share of the fast and successful traces that are sent anyway, slow and failed ones are always sent
+SENTRY_TRACES_SAMPLE_RATE = float(os.getenv('SENTRY_TRACES_SAMPLE_RATE', 0.05))
+# Traces that take longer than this are always sent
+SENTRY_SLOW_TRACE_SECONDS = float(os.getenv('SENTRY_SLOW_TRACE_SECONDS', 5.0))
+# Share of the traced updates that are profiled, profiling costs CPU on every one of them
+SENTRY_PROFILES_SAMPLE_RATE = float(os.getenv('SENTRY_PROFILES_SAMPLE_RATE', 0.0))
+
+# Span statuses that mark a trace as failed; not_found and the like are normal answers of the API
+FAILED_STATUSES = {'internal_error', 'unknown_error', 'deadline_exceeded', 'unavailable', 'aborted'}
+
+
+def traces_sampler(sampling_context: dict) -> float:
+    parent_sampled = sampling_context.get('parent_sampled')
+    if parent_sampled is not None:
+        return float(parent_sampled)
+    return SENTRY_TRACES_RECORD_RATE
+
+def _timestamp(value) -> float:
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return datetime.fromisoformat(value).timestamp()
+
+def _failed(event: dict) -> bool:
+    statuses = [event.get('contexts', {}).get('trace', {}).get('status')]
+    # span statuses are serialized as tags
+    statuses.extend(span.get('status', span.get('tags', {}).get('status')) for span in event.get('spans', []))
+    return any(status in FAILED_STATUSES for status in statuses)
+
+def before_send_transaction(event: dict, hint: dict) -> Optional[dict]:
+    """Tail sampling: keeps the slow and the failed traces, and a share of the rest"""
+
+    try:
+        duration = _timestamp(event['timestamp']) - _timestamp(event['start_timestamp'])
+    except (KeyError, TypeError, ValueError):
+        duration = 0.0
+    if duration >= SENTRY_SLOW_TRACE_SECONDS or _failed(event):
+        return event
+    if random.random() < SENTRY_TRACES_SAMPLE_RATE:
+        return event
+    return None
+
+def setup_sentry() -> None:
+    """Initializes Sentry, without SENTRY_DSN nothing is sent"""
+
+    sentry_sdk.init(
+        dsn=SENTRY_DSN,
+        environment=SENTRY_ENVIRONMENT,
+        traces_sampler=traces_sampler,
+        before_send_transaction=before_send_transaction,
+        profiles_sample_rate=SENTRY_PROFILES_SAMPLE_RATE,
+    )
+
+
+def traced(op: str):
+    """Decorator that wraps a coroutine function in a span named after the function"""
+
+    def decorator(func: Callable[..., Awaitable[Any]]):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with sentry_sdk.start_span(op=op, description=func.__name__):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def traced_job(func: Callable[..., Awaitable[Any]]):
+    """Decorator that traces a scheduled job or an event handler as a transaction of its own"""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with sentry_sdk.isolation_scope(), sentry_sdk.start_transaction(op='job', name=func.__name__, source='task'):
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Outer middleware that traces every update as a transaction, it should be registered before the other outer middlewares"""
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]], event: Update, data: dict[str, Any]) -> Any:
+        # updates are handled concurrently, each one gets its own scope
+        with sentry_sdk.isolation_scope(), sentry_sdk.start_transaction(op='aiogram.update', name=f'update.{event.event_type}', source='task'):
+            return await handler(event, data)
+
+
+class TelegramSpanMiddleware(BaseRequestMiddleware):
+    """Bot session middleware that wraps every call of the Telegram Bot API in a span"""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot: Bot, method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        with sentry_sdk.start_span(op='telegram', description=type(method).__name__):
+            return await make_request(bot, method)
+
+
+class TracedStorage(BaseStorage):
+    """FSM storage that wraps every call of the underlying storage in a span"""
+
+    def __init__(self, storage: BaseStorage):
+        self.storage = storage
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        with sentry_sdk.start_span(op='fsm', description='set_state'):
+            await self.storage.set_state(key, state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        with sentry_sdk.start_span(op='fsm', description='get_state'):
+            return await self.storage.get_state(key)
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        with sentry_sdk.start_span(op='fsm', description='set_data'):
+            await self.storage.set_data(key, data)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        with sentry_sdk.start_span(op='fsm', description='get_data'):
+            return await self.storage.get_data(key)
+
+    async def close(self) -> None:
+        await self.storage.close()
@@ -177,6 +177,14 @@ MESSAGES_DICT: AttrDict[str, TranslatedMessage] = AttrDict({
         ru='Спасибо за ваш отзыв! Он помогает мне улучшаться 🙏',
         es='¡Gracias por tu comentario! Me ayuda a mejorar 🙏'
     ),
+    'busy': TranslatedMessage(
+        en="I'm a bit overloaded right now 😅 Please, try again in a minute!",
+        ru='Я сейчас немного перегружен 😅 Пожалуйста, попробуйте ещё раз через минуту!',
+        es='Ahora mismo estoy un poco sobrecargado 😅 ¡Por favor, inténtalo de nuevo en un minuto!'
+    ),
+    'no_speech': TranslatedMessage(
+        en="I couldn't hear anything in your voice message 🎙 Please, try recording it again!",
+        ru='Я ничего не услышал в вашем голосовом сообщении 🎙 Пожалуйста, попробуйте записать его ещё раз!',
+        es='No pude oír nada en tu mensaje de voz 🎙 ¡Por favor, intenta grabarlo de nuevo!'
+    ),
 })
-
-
@@ -0,0 +1,72 @@
+"""Voice activity detection: silence is trimmed and compressed before a voice note is uploaded for transcription."""
+
+from dotenv import load_dotenv
+from pydub import AudioSegment
+
+import io
+import os
+
+import webrtcvad
+
+load_dotenv()
+
+# 0 keeps the most audio as speech, 3 filters non-speech the most aggressively
+VAD_AGGRESSIVENESS = int(os.getenv('VAD_AGGRESSIVENESS', 2))
+# Notes with less speech than this are rejected without transcription, milliseconds
+VAD_MIN_SPEECH_MS = int(os.getenv('VAD_MIN_SPEECH_MS', 300))
+# Pauses longer than this are cut down to twice VAD_PADDING_MS, shorter ones are kept as they are, milliseconds
+VAD_MAX_PAUSE_MS = int(os.getenv('VAD_MAX_PAUSE_MS', 600))
+# Audio kept around every speech region so the words are not clipped, milliseconds
+VAD_PADDING_MS = 200
+# The detector works on 16 kHz mono 16-bit PCM in frames of 10, 20 or 30 ms
+VAD_SAMPLE_RATE = 16000
+VAD_FRAME_MS = 30
+
+
+class NoSpeechDetected(Exception):
+    """Raised when a voice note has no speech in it"""
+
+
+def decode_pcm(buffer_data: bytes) -> AudioSegment:
+    """Decodes a voice note (Opus from Telegram, or any format ffmpeg reads) to the PCM the detector needs"""
+    audio = AudioSegment.from_file(io.BytesIO(buffer_data))
+    return audio.set_frame_rate(VAD_SAMPLE_RATE).set_channels(1).set_sample_width(2)
+
+def speech_regions(audio: AudioSegment, aggressiveness: int = VAD_AGGRESSIVENESS) -> list[tuple[int, int]]:
+    """Returns (start, end) milliseconds of the speech, pauses up to VAD_MAX_PAUSE_MS don't split a region"""
+
+    vad = webrtcvad.Vad(aggressiveness)
+    pcm = audio.raw_data
+    frame_bytes = VAD_SAMPLE_RATE * VAD_FRAME_MS // 1000 * 2
+
+    regions = []
+    for offset in range(0, len(pcm) - frame_bytes + 1, frame_bytes):
+        if not vad.is_speech(pcm[offset:offset + frame_bytes], VAD_SAMPLE_RATE):
+            continue
+        start = offset // frame_bytes * VAD_FRAME_MS
+        end = start + VAD_FRAME_MS
+        if regions and start - regions[-1][1] <= VAD_MAX_PAUSE_MS:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+    return regions
+
+def trim_silence(buffer_data: bytes) -> tuple[bytes, float]:
+    """
+    Cuts leading and trailing silence and shortens the pauses longer than VAD_MAX_PAUSE_MS.
+    Returns the Opus-encoded speech and its duration in seconds, raises NoSpeechDetected if there is no speech.
+    CPU-bound, should be run in a thread.
+    """
+
+    audio = decode_pcm(buffer_data)
+    regions = speech_regions(audio)
+    if sum(end - start for start, end in regions) < VAD_MIN_SPEECH_MS:
+        raise NoSpeechDetected(f'No speech in {len(audio)} ms of audio')
+
+    speech = AudioSegment.empty()
+    for start, end in regions:
+        speech += audio[max(0, start - VAD_PADDING_MS):min(len(audio), end + VAD_PADDING_MS)]
+
+    out = io.BytesIO()
+    speech.export(out, format='ogg', codec='libopus')
+    return out.getvalue(), len(speech) / 1000
@@ -1,46 +1,293 @@
 from deepgram import DeepgramClient, PrerecordedOptions, FileSource
 from dotenv import load_dotenv
+from pydub import AudioSegment, silence
 
-import aiofiles
+from abc import ABC, abstractmethod
+from typing import Optional
+import asyncio
+import logging
+import threading
 import aiofiles.os
+import io
 import os
+import re
 import time
 
 from utils import SUPPORTED_LANGS
+from tracing import traced
+from vad import trim_silence, NoSpeechDetected
+from priority import PriorityLimiter
+
+try:
+    from faster_whisper import WhisperModel
+except ImportError:
+    # the local engine is optional: poetry install --extras local-stt
+    WhisperModel = None
 
 load_dotenv()
 
 DEEPGRAM_API_KEY = os.getenv('DEEPGRAM_API_KEY')
 deepgram = DeepgramClient(DEEPGRAM_API_KEY)
 
-async def voice_to_text(audio_file_path: str, lang: str) -> str:
-    """Converts voice to text using Deepgram API"""
-    
-    if lang not in SUPPORTED_LANGS:
-        raise ValueError(f'Unsupported language: {lang}')
-    
-    deepgram = DeepgramClient()
-    options = PrerecordedOptions(model="nova-2", smart_format=True, language=lang)
-    
-    async with aiofiles.open(audio_file_path, 'rb') as audio_file:
-        
-        buffer_data = await audio_file.read()
+# Voice notes longer than this many seconds are split and transcribed in parallel
+LONG_AUDIO_THRESHOLD = int(os.getenv('LONG_AUDIO_THRESHOLD', 45))
+# Target chunk length for long voice notes, seconds
+LONG_AUDIO_CHUNK = int(os.getenv('LONG_AUDIO_CHUNK', 20))
+# Chunks transcribed at once for one voice note
+LONG_AUDIO_MAX_PARALLEL = int(os.getenv('LONG_AUDIO_MAX_PARALLEL', 6))
+# Overlap added around hard cuts (when there is no silence to cut at), milliseconds
+LONG_AUDIO_OVERLAP = 1000
+# Pause that counts as a silence boundary, milliseconds
+MIN_SILENCE_LEN = 300
+# Max number of words de-duplicated between two neighbouring chunks
+MAX_OVERLAP_WORDS = 8
+# Silence is trimmed with voice activity detection before the upload
+VAD_ENABLED = os.getenv('VAD_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Deepgram calls taking longer than this are abandoned for the local engine, seconds
+DEEPGRAM_TIMEOUT = float(os.getenv('DEEPGRAM_TIMEOUT', 20.0))
+# Consecutive Deepgram failures after which notes go straight to the local engine, and for how long, seconds
+DEEPGRAM_CIRCUIT_THRESHOLD = int(os.getenv('DEEPGRAM_CIRCUIT_THRESHOLD', 3))
+DEEPGRAM_CIRCUIT_COOLDOWN = float(os.getenv('DEEPGRAM_CIRCUIT_COOLDOWN', 60.0))
+# faster-whisper model of the local engine (tiny, base, small...), empty disables the engine
+LOCAL_STT_MODEL = os.getenv('LOCAL_STT_MODEL', 'base')
+LOCAL_STT_THREADS = int(os.getenv('LOCAL_STT_THREADS', 4))
+# Notes up to this many seconds are transcribed locally, 0 uses the local engine only as a fallback
+LOCAL_STT_MAX_SHORT = float(os.getenv('LOCAL_STT_MAX_SHORT', 0))
+# Deepgram requests running at once, and how many of them scheduled jobs can't take
+DEEPGRAM_MAX_CONCURRENT = int(os.getenv('DEEPGRAM_MAX_CONCURRENT', 16))
+DEEPGRAM_INTERACTIVE_RESERVED = int(os.getenv('DEEPGRAM_INTERACTIVE_RESERVED', 4))
+
+class TranscriptionBackend(ABC):
+    """Speech-to-text engine, transcribes encoded audio in one of the SUPPORTED_LANGS"""
+
+    name: str
+
+    def available(self) -> bool:
+        return True
+
+    @abstractmethod
+    async def transcribe(self, buffer_data: bytes, lang: str) -> str:
+        """Returns the transcript of the audio"""
+
+
+class DeepgramBackend(TranscriptionBackend):
+    name = 'deepgram'
+
+    @traced('deepgram')
+    async def transcribe(self, buffer_data: bytes, lang: str) -> str:
+        """Transcribes audio bytes using Deepgram API"""
+
+        deepgram = DeepgramClient()
+        options = PrerecordedOptions(model="nova-2", smart_format=True, language=lang)
         payload: FileSource = {
             'buffer': buffer_data,
         }
-        
         file_response = await deepgram.listen.asyncprerecorded.v("1").transcribe_file(payload, options)
-        
-    # save the response to json file
-    output_dir = 'deepgram_responses'
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    with open(os.path.join(output_dir, f'{time.time()}.json'), 'w') as f:
-        f.write(file_response.to_json())
-    
-    return file_response.to_dict()['results']['channels'][0]['alternatives'][0]['transcript']
-    
+
+        # save the response to json file
+        output_dir = 'deepgram_responses'
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        with open(os.path.join(output_dir, f'{time.time()}.json'), 'w') as f:
+            f.write(file_response.to_json())
+
+        return file_response.to_dict()['results']['channels'][0]['alternatives'][0]['transcript']
+
+
+class LocalWhisperBackend(TranscriptionBackend):
+    """Transcription on the CPU with faster-whisper, available when the local-stt extra is installed"""
+
+    name = 'local'
+
+    def __init__(self, model_name: str = LOCAL_STT_MODEL):
+        self.model_name = model_name
+        self._model = None
+        self._load_lock = threading.Lock()
+        # inference uses all the CPU threads it is given, notes are transcribed one at a time
+        self._semaphore = asyncio.Semaphore(1)
+
+    def available(self) -> bool:
+        return WhisperModel is not None and bool(self.model_name)
+
+    def load(self):
+        with self._load_lock:
+            if self._model is None:
+                self._model = WhisperModel(self.model_name, device='cpu', compute_type='int8', cpu_threads=LOCAL_STT_THREADS)
+        return self._model
+
+    def _transcribe(self, buffer_data: bytes, lang: str) -> str:
+        segments, _ = self.load().transcribe(io.BytesIO(buffer_data), language=lang, beam_size=1, vad_filter=False)
+        return ' '.join(segment.text.strip() for segment in segments)
+
+    @traced('local_stt')
+    async def transcribe(self, buffer_data: bytes, lang: str) -> str:
+        async with self._semaphore:
+            return await asyncio.to_thread(self._transcribe, buffer_data, lang)
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and lets one trial call through every `cooldown` seconds"""
+
+    def __init__(self, threshold: int = DEEPGRAM_CIRCUIT_THRESHOLD, cooldown: float = DEEPGRAM_CIRCUIT_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def is_open(self) -> bool:
+        if self.failures < self.threshold:
+            return False
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            # half-open: the next call is a trial, a failure opens the circuit again
+            self.opened_at = time.monotonic()
+            return False
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+deepgram_backend = DeepgramBackend()
+local_backend = LocalWhisperBackend()
+deepgram_circuit = CircuitBreaker()
+DEEPGRAM_LIMITER = PriorityLimiter('deepgram', DEEPGRAM_MAX_CONCURRENT, DEEPGRAM_INTERACTIVE_RESERVED)
+
+async def preload_local_engine() -> None:
+    """Loads the local model in the background, so the first fallback doesn't wait for it"""
+    if local_backend.available():
+        await asyncio.to_thread(local_backend.load)
+
+async def transcribe_buffer(buffer_data: bytes, lang: str, duration: Optional[float] = None) -> str:
+    """
+    Transcribes audio bytes with Deepgram, or with the local engine if it is available and
+    the note is short enough that local inference beats the round trip, the Deepgram circuit is open, or Deepgram fails or times out.
+    """
+
+    local = local_backend.available()
+    if local and duration is not None and duration <= LOCAL_STT_MAX_SHORT:
+        return await local_backend.transcribe(buffer_data, lang)
+    if local and deepgram_circuit.is_open():
+        return await local_backend.transcribe(buffer_data, lang)
+
+    try:
+        async with DEEPGRAM_LIMITER.slot():
+            text = await asyncio.wait_for(deepgram_backend.transcribe(buffer_data, lang), timeout=DEEPGRAM_TIMEOUT)
+    except Exception as e:
+        deepgram_circuit.record_failure()
+        if not local:
+            raise
+        logging.warning(f"Deepgram transcription failed, falling back to the local engine: {e!r}")
+        return await local_backend.transcribe(buffer_data, lang)
+    deepgram_circuit.record_success()
+    return text
+
+def read_audio_file(path: str) -> bytes:
+    with open(path, 'rb') as audio_file:
+        return audio_file.read()
+
+async def voice_to_text(audio_file_path: str, lang: str, duration: Optional[int] = None) -> str:
+    """
+    Converts voice to text, with Deepgram or the local engine as transcribe_buffer decides.
+    Silence is trimmed first and notes without speech raise NoSpeechDetected, Deepgram is not called for them.
+    If the duration in seconds of the trimmed audio exceeds LONG_AUDIO_THRESHOLD, it is split at silence and the chunks are transcribed in parallel.
+    """
+
+    if lang not in SUPPORTED_LANGS:
+        raise ValueError(f'Unsupported language: {lang}')
+
+    buffer_data = await asyncio.to_thread(read_audio_file, audio_file_path)
+
+    if VAD_ENABLED:
+        try:
+            # decoding and detection are CPU-bound, keep them off the event loop
+            buffer_data, duration = await asyncio.to_thread(trim_silence, buffer_data)
+        except NoSpeechDetected:
+            raise
+        except Exception as e:
+            # the original audio is still fine for transcription
+            logging.warning(f"Could not trim silence in {audio_file_path}: {e}")
+
+    if duration is None or duration <= LONG_AUDIO_THRESHOLD:
+        return await transcribe_buffer(buffer_data, lang, duration)
+
+    # decoding and encoding are CPU-bound, keep them off the event loop
+    chunks, overlapped = await asyncio.to_thread(split_audio, buffer_data)
+    semaphore = asyncio.Semaphore(LONG_AUDIO_MAX_PARALLEL)
+
+    async def transcribe_chunk(chunk: bytes) -> str:
+        async with semaphore:
+            return await transcribe_buffer(chunk, lang)
+
+    transcripts = await asyncio.gather(*(transcribe_chunk(chunk) for chunk in chunks))
+    return merge_transcripts(transcripts, overlapped)
+
+def find_cut_points(audio: AudioSegment, chunk_len: int) -> list[tuple[int, int, bool]]:
+    """
+    Returns (start, end, overlapped) of the chunks, in milliseconds; overlapped is set when the chunk starts inside the overlap of a hard cut.
+    Chunks end in the middle of the pause closest to the target length, or get a hard cut with overlap if there is no pause.
+    """
+
+    pauses = silence.detect_silence(audio, min_silence_len=MIN_SILENCE_LEN, silence_thresh=audio.dBFS - 16, seek_step=10)
+    cut_candidates = [(start + end) // 2 for start, end in pauses]
+
+    bounds = []
+    start = 0
+    overlapped = False
+    while len(audio) - start > chunk_len * 1.5:
+        target = start + chunk_len
+        # accept pauses within half a chunk from the target
+        window = [cut for cut in cut_candidates if abs(cut - target) <= chunk_len // 2 and cut > start]
+        if window:
+            cut = min(window, key=lambda cut: abs(cut - target))
+            bounds.append((start, cut, overlapped))
+            start = cut
+            overlapped = False
+        else:
+            bounds.append((start, target + LONG_AUDIO_OVERLAP // 2, overlapped))
+            start = target - LONG_AUDIO_OVERLAP // 2
+            overlapped = True
+    bounds.append((start, len(audio), overlapped))
+    return bounds
+
+def split_audio(buffer_data: bytes, chunk_seconds: int = LONG_AUDIO_CHUNK) -> tuple[list[bytes], list[bool]]:
+    """Splits encoded audio into Opus-encoded chunks at silence boundaries, also returns which chunks start inside a hard cut overlap"""
+
+    audio = AudioSegment.from_file(io.BytesIO(buffer_data))
+    chunks = []
+    overlapped = []
+    for start, end, chunk_overlapped in find_cut_points(audio, chunk_seconds * 1000):
+        out = io.BytesIO()
+        audio[start:end].export(out, format='ogg', codec='libopus')
+        chunks.append(out.getvalue())
+        overlapped.append(chunk_overlapped)
+    return chunks, overlapped
+
+def _normalize_word(word: str) -> str:
+    return re.sub(r'\W', '', word).lower()
+
+def merge_transcripts(transcripts: list[str], overlapped: list[bool]) -> str:
+    """
+    Joins chunk transcripts in order, dropping words repeated on both sides of a hard cut.
+    Only chunks marked as overlapped are de-duplicated, a cut at silence loses nothing and repeats around it are real.
+    """
+
+    words = []
+    for transcript, chunk_overlapped in zip(transcripts, overlapped):
+        next_words = transcript.split()
+        overlap = 0
+        for size in range(min(MAX_OVERLAP_WORDS, len(words), len(next_words)) if chunk_overlapped else 0, 0, -1):
+            if [_normalize_word(word) for word in words[-size:]] == [_normalize_word(word) for word in next_words[:size]]:
+                overlap = size
+                break
+        words.extend(next_words[overlap:])
+    return ' '.join(words)
+
 
 async def clean_audio_file(file_path: str) -> None:
     """Deletes audio file"""
-    await aiofiles.os.remove(file_path)
\ No newline at end of file
+    await aiofiles.os.remove(file_path)